@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+
+"""
+Rough benchmarks for comparing new helpers against the existing utilities
+
+Run directly to execute all of them::
+
+    python benchmarks.py
+"""
+
+# Standard Library
+import os
+import gc
+import sys
+import json
+import ctypes
+import shutil
+import cPickle
+import resource
+import tempfile
+from time import time
+
+# Third Party
+from lxml import etree
+
+# Local
+import utils
+import binary
+from cache import DocumentCache
+from extensions import Interner
+from mapping import MappingSpec, Field
+from transform import TransformChain
+from stream import find_first, search
+from document import Document
+
+
+def best_of(fn, iterations=5, *args, **kwargs):
+    # type: (function, int, *Any, **Any) -> tuple
+    """
+    Calls ``fn`` ``iterations`` times and returns the fastest run
+
+    Unlike ``debug.timeit`` this doesn't copy the arguments or print anything,
+    so it can be used to compare several functions side by side.
+
+    :param function fn: Function to time
+    :param int iterations: # times to execute the function (Default ``5``)
+    :returns: (fastest run time in seconds, result of the last call)
+    :rtype: tuple
+    """
+    best, result = None, None
+    for x in xrange(iterations):
+        s = time()
+        result = fn(*args, **kwargs)
+        t = time() - s
+        best = t if best is None or t < best else best
+    return best, result
+
+
+def report(title, rows):
+    # type: (str, list) -> None
+    """
+    Prints a list of (label, value) rows under a title
+
+    :param str title:
+    :param list rows:
+    :rtype: None
+    """
+    print '\n' + '{:-^60}'.format(' ' + title + ' ')
+    for label, value in rows:
+        if isinstance(value, float):
+            value = '{:.2f} ms'.format(value * 1000)
+        value = str(value)
+        print '    {:<36}{:>20}'.format(label, value)
+
+
+def deep_sizeof(obj):
+    # type: (Any) -> int
+    """
+    Approximate memory used by ``obj`` and everything it references, counting
+    shared objects once
+
+    :param Any obj: dict/list/tuple/set structure to measure
+    :returns: Size in bytes
+    :rtype: int
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+    return size
+
+
+def rss_growth(fn, *args):
+    # type: (function, *Any) -> int
+    """
+    Resident memory added by building & keeping ``fn(*args)``, measured in a
+    forked child so libxml2 allocations count and earlier runs can't skew it
+
+    :param function fn:
+    :returns: Growth in bytes
+    :rtype: int
+    """
+    def rss():
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize()
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        # hand the parent's freed heap back to the OS first, otherwise the
+        # child builds in memory that's already resident
+        gc.collect()
+        ctypes.CDLL(None).malloc_trim(0)
+        before = rss()
+        keep = fn(*args)
+        os.write(write, str(rss() - before))
+        os._exit(0 if keep is not None else 1)
+    os.close(write)
+    data = os.read(read, 64)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return int(data)
+
+
+def sample_deal(fees=50):
+    # type: (int) -> str
+    """
+    Builds a namespaced deal document with ``fees`` repeated Fee nodes
+
+    :param int fees:
+    :rtype: str
+    """
+    items = ''.join('<ns:Fee>{}</ns:Fee>'.format(x) for x in xrange(fees))
+    return (
+        '<ns:Deal xmlns:ns="urn:deal" id="D-1">'
+        '<ns:Customer type="business"><ns:Name>ACME</ns:Name>'
+        '<ns:Phone>555-0100</ns:Phone></ns:Customer>'
+        '<ns:Vehicle><ns:VIN>1HGCM82633A004352</ns:VIN>'
+        '<ns:Year>2017</ns:Year></ns:Vehicle>'
+        '<ns:Fees>{}</ns:Fees></ns:Deal>'
+    ).format(items)
+
+
+def bench_mapping(docs=200, fees=50):
+    # type: (int, int) -> None
+    """
+    Compiled ``Mapper`` vs ``apply_xslt()`` running an equivalent stylesheet
+
+    :param int docs: # of documents to map per run
+    :param int fees: # of repeated Fee nodes per document
+    :rtype: None
+    """
+    xsl = (
+        '<xsl:stylesheet version="1.0" '
+        'xmlns:xsl="http://www.w3.org/1999/XSL/Transform" '
+        'xmlns:ns="urn:deal" exclude-result-prefixes="ns">'
+        '<xsl:template match="/ns:Deal"><Contract>'
+        '<xsl:attribute name="ref"><xsl:value-of select="@id"/>'
+        '</xsl:attribute>'
+        '<Buyer><xsl:attribute name="kind">'
+        '<xsl:value-of select="ns:Customer/@type"/></xsl:attribute>'
+        '<FullName><xsl:value-of select="ns:Customer/ns:Name"/></FullName>'
+        '</Buyer>'
+        '<Asset><Id><xsl:value-of select="ns:Vehicle/ns:VIN"/></Id></Asset>'
+        '<Charges><xsl:for-each select="ns:Fees/ns:Fee">'
+        '<Charge><xsl:value-of select="."/></Charge></xsl:for-each></Charges>'
+        '</Contract></xsl:template></xsl:stylesheet>'
+    )
+    spec = MappingSpec('Contract', [
+        Field('@id', '@ref'),
+        Field('Customer/@type', 'Buyer/@kind'),
+        Field('Customer/Name', 'Buyer/FullName'),
+        Field('Vehicle/VIN', 'Asset/Id'),
+        Field('Fees/Fee', 'Charges/Charge', max_occurs=None),
+    ], source_root='Deal')
+    mapper = spec.compile()
+    deal = sample_deal(fees)
+    fd, path = tempfile.mkstemp(suffix='.xsl')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(xsl)
+        t_xslt, r_xslt = best_of(lambda: [utils.apply_xslt(path, deal)
+                                          for _ in xrange(docs)])
+        t_map, r_map = best_of(lambda: [mapper(deal) for _ in xrange(docs)])
+        # already parsed records, e.g. from a Pipeline
+        tree = etree.fromstring(deal)
+        t_xslt_tree, _ = best_of(lambda: [utils.apply_xslt(path, tree)
+                                          for _ in xrange(docs)])
+        t_map_tree, _ = best_of(lambda: [mapper(tree) for _ in xrange(docs)])
+    finally:
+        os.remove(path)
+    same = etree.tostring(r_xslt[0]) == etree.tostring(r_map[0])
+    report('mapping: {} docs x {} fees'.format(docs, fees), [
+        ('apply_xslt()', t_xslt),
+        ('Mapper', t_map),
+        ('speedup', '{:.1f}x'.format(t_xslt / t_map)),
+        ('apply_xslt(), parsed input', t_xslt_tree),
+        ('Mapper, parsed input', t_map_tree),
+        ('speedup, parsed input', '{:.1f}x'.format(t_xslt_tree / t_map_tree)),
+        ('identical output', same),
+    ])
+
+
+def sample_records(records=5000):
+    # type: (int) -> list
+    """
+    Builds ``records`` repetitive deal records as ``etree_to_dict()`` results
+
+    :param int records:
+    :rtype: list
+    """
+    record = (
+        '<Deal><Status code="OPEN" type="RETAIL"/>'
+        '<Customer type="business"><Name>ACME {0}</Name>'
+        '<State>NY</State><Country>US</Country></Customer>'
+        '<Vehicle><VIN>1HGCM82633A{0:06d}</VIN><Make>HONDA</Make>'
+        '<Year>2017</Year><New>false</New></Vehicle></Deal>'
+    )
+    return [etree.fromstring(record.format(x)) for x in xrange(records)]
+
+
+def bench_interning(records=5000):
+    # type: (int) -> None
+    """
+    Memory used by ``etree_to_dict()`` results with and without an
+    ``Interner`` on a repetitive feed
+
+    :param int records: # of records to convert
+    :rtype: None
+    """
+    docs = sample_records(records)
+    raw = sum(len(etree.tostring(d)) for d in docs)
+    t_plain, plain = best_of(
+        lambda: [utils.etree_to_dict(d, stripped=True) for d in docs], 3)
+    interner = Interner()
+    t_keys, keys = best_of(
+        lambda: [utils.etree_to_dict(d, stripped=True, interner=interner)
+                 for d in docs], 3)
+    interner = Interner(values=True)
+    t_shared, shared = best_of(
+        lambda: [utils.etree_to_dict(d, stripped=True, interner=interner)
+                 for d in docs], 3)
+    base = deep_sizeof(plain)
+    report('interning: {} records'.format(records), [
+        ('raw xml', '{:,} bytes'.format(raw)),
+        ('etree_to_dict()', '{:,} bytes'.format(base)),
+        ('shared interner', '{:,} bytes'.format(deep_sizeof(keys))),
+        ('shared interner, values=True',
+         '{:,} bytes'.format(deep_sizeof(shared))),
+        ('saved (shared, values=True)',
+         '{:.0%}'.format(1 - deep_sizeof(shared) / float(base))),
+        ('etree_to_dict() time', t_plain),
+        ('shared interner time', t_shared),
+    ])
+
+
+def bench_cache(rates=20000):
+    # type: (int) -> None
+    """
+    ``etree_to_dict()`` on a reference file vs loading it from a warm
+    ``DocumentCache``
+
+    :param int rates: # of rate nodes in the reference file
+    :rtype: None
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'rates.xml')
+        with open(path, 'w') as fh:
+            fh.write('<Rates>')
+            for x in xrange(rates):
+                fh.write('<Rate{0} code="C{0}"><Amt>{0}.5</Amt>'
+                         '<Term>36</Term></Rate{0}>'.format(x))
+            fh.write('</Rates>')
+        cache = DocumentCache(os.path.join(tmp, 'cache'))
+        t_parse, parsed = best_of(utils.etree_to_dict, 3, path)
+        cache.load(path)
+        t_cached, cached = best_of(cache.load, 3, path)
+        report('cache: {:,} byte reference file'.format(os.path.getsize(path)), [
+            ('etree_to_dict()', t_parse),
+            ('DocumentCache.load() (warm)', t_cached),
+            ('speedup', '{:.1f}x'.format(t_parse / t_cached)),
+            ('identical result', parsed == cached),
+            ('cache size', '{:,} bytes'.format(cache.size())),
+        ])
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_binary(records=5000):
+    # type: (int) -> None
+    """
+    Size & speed of the ``binary`` format vs pickle & JSON for a batch of
+    ``etree_to_dict()`` results
+
+    :param int records: # of records in the batch
+    :rtype: None
+    """
+    batch = [utils.etree_to_dict(d, stripped=True)
+             for d in sample_records(records)]
+    formats = [
+        ('pickle', lambda b: cPickle.dumps(b, cPickle.HIGHEST_PROTOCOL),
+         cPickle.loads),
+        ('json', json.dumps, json.loads),
+        ('binary', binary.dumps, binary.loads),
+    ]
+    rows = []
+    for name, dump, load in formats:
+        t_dump, data = best_of(dump, 3, batch)
+        t_load, back = best_of(load, 3, data)
+        rows.extend([
+            (name + ' size', '{:,} bytes'.format(len(data))),
+            (name + ' encode', t_dump),
+            (name + ' decode', t_load),
+        ])
+        assert back == batch
+    report('interchange: {} records'.format(records), rows)
+
+
+def bench_transform_chain(docs=200, fees=50):
+    # type: (int, int) -> None
+    """
+    ``TransformChain`` vs ``strip_namespaces()`` followed by ``apply_xslt()``
+    calls for each stylesheet
+
+    :param int docs: # of documents to transform per run
+    :param int fees: # of repeated Fee nodes per document
+    :rtype: None
+    """
+    head = ('<xsl:stylesheet version="1.0" '
+            'xmlns:xsl="http://www.w3.org/1999/XSL/Transform">'
+            '<xsl:template match="@*|node()"><xsl:copy>'
+            '<xsl:apply-templates select="@*|node()"/></xsl:copy>'
+            '</xsl:template>')
+    stylesheets = [
+        head + '<xsl:template match="Phone"/></xsl:stylesheet>',
+        head + '<xsl:param name="dealer"/><xsl:template match="Deal">'
+               '<Deal dealer="{$dealer}"><xsl:apply-templates/></Deal>'
+               '</xsl:template></xsl:stylesheet>',
+        head + '<xsl:template match="Fee"><Charge>'
+               '<xsl:value-of select="."/></Charge></xsl:template>'
+               '</xsl:stylesheet>',
+    ]
+    params = [None, {'dealer': 'D-100'}, None]
+    deal = sample_deal(fees)
+    tmp = tempfile.mkdtemp()
+    try:
+        paths = []
+        for x, xsl in enumerate(stylesheets):
+            paths.append(os.path.join(tmp, 'stage{}.xsl'.format(x)))
+            with open(paths[-1], 'w') as fh:
+                fh.write(xsl)
+
+        def chained():
+            result = utils.strip_namespaces(deal)
+            for path, p in zip(paths, params):
+                result = utils.apply_xslt(path, result, p)
+            return result
+
+        chain = TransformChain(zip(paths, params), strip_namespaces=True)
+        t_calls, r_calls = best_of(lambda: [chained() for _ in xrange(docs)])
+        chain.compile()
+        t_chain, r_chain = best_of(
+            lambda: list(chain.transform_all(deal for _ in xrange(docs))))
+    finally:
+        shutil.rmtree(tmp)
+    same = etree.tostring(r_calls[0]) == etree.tostring(r_chain[0])
+    rows = [
+        ('apply_xslt() calls', t_calls),
+        ('TransformChain', t_chain),
+        ('speedup', '{:.1f}x'.format(t_calls / t_chain)),
+        ('identical output', same),
+    ]
+    # every best_of() run added to the chain's timings
+    runs = float(chain.documents)
+    rows.extend(('  ' + name, seconds / runs * docs)
+                for name, seconds in chain.timings.items())
+    report('transform chain: {} docs x {} fees'.format(docs, fees), rows)
+
+
+def bench_search(records=100000):
+    # type: (int) -> None
+    """
+    ``find_first()``/``search()`` vs ``get_attr()`` for header fields near the
+    start of a big feed
+
+    :param int records: # of Deal records after the header
+    :rtype: None
+    """
+    fd, path = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write('<ns:Feed xmlns:ns="urn:deal"><ns:Header txn="T-42">'
+                     '<ns:Sender>ACME</ns:Sender></ns:Header>')
+            for x in xrange(records):
+                fh.write('<ns:Deal id="{0}"><ns:VIN>1HGCM82633A{0:06d}'
+                         '</ns:VIN></ns:Deal>'.format(x))
+            fh.write('</ns:Feed>')
+        size = os.path.getsize(path)
+        t_get, r_get = best_of(
+            utils.get_attr, 3, path, '{urn:deal}Header', 'txn')
+        t_find, r_find = best_of(find_first, 3, path, 'Header/@txn')
+        t_batch, r_batch = best_of(
+            search, 3, path, ['Header/@txn', 'Header/Sender', 'Deal/@id'])
+    finally:
+        os.remove(path)
+    report('search: {:,} byte feed'.format(size), [
+        ('get_attr()', t_get),
+        ('find_first()', t_find),
+        ('search(), 3 paths', t_batch),
+        ('speedup', '{:.0f}x'.format(t_get / t_find)),
+        ('same value', r_get == r_find == r_batch['Header/@txn'][0]),
+    ])
+
+
+def bench_builder(records=20000):
+    # type: (int) -> None
+    """
+    ``Document`` builder vs ``dict_to_etree()`` for a feed of ``records``
+    Deal nodes: build time, memory & output
+
+    :param int records:
+    :rtype: None
+    """
+    fields = {'Name': 'ACME', 'State': 'NY', 'Year': '2017'}
+    # the builder adds fields in the order the dicts iterate them, so the
+    # output can be compared
+    order = [(k, fields.get(k)) for k in dict(fields, Id='')]
+
+    def with_dicts():
+        return utils.dict_to_etree({'Deals': [
+            {'Deal': dict(fields, Id=str(x))} for x in xrange(records)]})
+
+    def with_builder():
+        doc = Document('Deals')
+        deals = doc.root
+        for x in xrange(records):
+            deal = deals.add_child('Deal')
+            for name, value in order:
+                deal.add_child(name, x if value is None else value)
+        return doc
+
+    def repeated_dicts():
+        return utils.dict_to_etree(
+            {'Fees': [{'Fee': str(x)} for x in xrange(records * 5)]})
+
+    def repeated_loop():
+        fees = Document('Fees').root
+        for x in xrange(records * 5):
+            fees.add_child('Fee', x)
+        return fees
+
+    def repeated_bulk():
+        return Document('Fees').root.add_children('Fee', xrange(records * 5))
+
+    t_dict, r_dict = best_of(with_dicts, 3)
+    t_build, r_build = best_of(with_builder, 3)
+    t_lower, r_lower = best_of(r_build.to_etree, 3)
+    t_tostring, out_dict = best_of(etree.tostring, 3, r_dict)
+    t_write, out_build = best_of(r_build.serialize, 3)
+    t_rep_dict, _ = best_of(repeated_dicts, 3)
+    t_rep_loop, _ = best_of(repeated_loop, 3)
+    t_rep_bulk, _ = best_of(repeated_bulk, 3)
+    report('builder: {} records'.format(records), [
+        ('dict_to_etree()', t_dict),
+        ('Document build', t_build),
+        ('Document.to_etree()', t_lower),
+        ('dict_to_etree() + tostring()', t_dict + t_tostring),
+        ('Document build + serialize()', t_build + t_write),
+        ('Document build + lxml tostring()', t_build + t_lower + t_tostring),
+        ('dict_to_etree() memory',
+         '{:,} bytes'.format(rss_growth(with_dicts))),
+        ('Document memory', '{:,} bytes'.format(rss_growth(with_builder))),
+        ('identical tree',
+         etree.tostring(r_dict) == etree.tostring(r_lower)),
+        ('identical output', out_build.split('\n', 1)[1] == out_dict),
+        ('{:,} Fee nodes: dict_to_etree()'.format(records * 5), t_rep_dict),
+        ('{:,} Fee nodes: add_child()'.format(records * 5), t_rep_loop),
+        ('{:,} Fee nodes: add_children()'.format(records * 5), t_rep_bulk),
+    ])
+
+
+if __name__ == '__main__':
+    bench_mapping()
+    bench_interning()
+    bench_cache()
+    bench_binary()
+    bench_transform_chain()
+    bench_search()
+    bench_builder()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+"""
+Persistent, multi-process cache for converted reference documents
+
+Reconciliation jobs load the same big reference files (rate tables, code
+lists, ...) over & over. ``DocumentCache`` stores the converted result in a
+binary (pickle) form on disk, so later loads, from any process, skip the
+parse/convert step entirely::
+
+    >>> cache = DocumentCache('/var/cache/xml_minion', max_bytes=2 * 1024 ** 3)
+    >>> rates = cache.load('/data/rates.xml')  # etree_to_dict() result
+
+Entries are keyed by the file's content hash plus the converter used. The
+hash of each file is remembered together with its path, size & mtime, so an
+unchanged file is never read just to be hashed again. Remembered hashes count
+toward ``max_bytes`` and are evicted the same way entries are.
+
+All writes go to a temp file that is renamed into place, so readers never see
+partial entries and no read locks are needed. Eviction of the least recently
+used entries, once the cache is over ``max_bytes``, runs under an exclusive
+``flock`` so only one process does it at a time.
+
+Entries are unpickled when they're loaded, so anyone who can write to the
+cache directory can run code in the processes using it. The directories are
+created with mode ``0700``, and ``DocumentCache`` refuses to use a directory
+that's owned by another user or writable by group/others.
+"""
+
+# Standard Library
+import os
+import json
+import fcntl
+import errno
+import hashlib
+import tempfile
+import cPickle
+
+# Third Party
+from lxml import etree
+
+# Local
+from utils import etree_to_dict
+
+# bump if the entry format changes so old entries are ignored
+CACHE_VERSION = 2
+HASH_CHUNK = 1024 * 1024
+
+
+def file_hash(path):
+    # type: (str) -> str
+    """
+    :param str path:
+    :returns: sha1 hex digest of the file's contents
+    :rtype: str
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DocumentCache(object):
+    """
+    On-disk cache of converted XML files
+
+    :param str directory: Cache directory; created with mode ``0700`` if
+                          needed. Must be owned by the current user and not
+                          writable by anyone else.
+    :param int max_bytes: Evict least recently used entries once the cache
+                          is bigger than this (Default 1GB)
+    :raises: OSError if ``directory`` is owned by, or writable by, other
+             users
+    """
+    def __init__(self, directory, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        for sub in ('entries', 'stats'):
+            try:
+                os.makedirs(os.path.join(directory, sub), 0700)
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+        for path in (directory, os.path.join(directory, 'entries'),
+                     os.path.join(directory, 'stats')):
+            st = os.stat(path)
+            if st.st_uid != os.getuid() or st.st_mode & 022:
+                err = ('Cache directory is owned by, or writable by, other '
+                       'users')
+                raise OSError(errno.EPERM, err, path)
+
+    def _path(self, kind, key):
+        # type: (str, str) -> str
+        return os.path.join(self.directory, kind, key)
+
+    def content_hash(self, path):
+        # type: (str) -> str
+        """
+        Returns the content hash of ``path``, only re-hashing the file if its
+        size or mtime changed since it was last seen
+
+        :param str path:
+        :rtype: str
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stat_path = self._path('stats', hashlib.sha1(path).hexdigest())
+        try:
+            with open(stat_path) as fh:
+                known = json.load(fh)
+            if known['path'] == path and known['size'] == st.st_size and \
+                    known['mtime'] == st.st_mtime:
+                # stats are evicted with the entries, least recently used
+                # first
+                os.utime(stat_path, None)
+                return known['hash']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        digest = file_hash(path)
+        known = {'path': path, 'size': st.st_size, 'mtime': st.st_mtime,
+                 'hash': digest}
+        self._write(stat_path, json.dumps(known))
+        return digest
+
+    def key(self, path, converter_name):
+        # type: (str, str) -> str
+        """
+        :param str path: Source file
+        :param str converter_name: Identifies the conversion applied
+        :returns: Cache entry key for ``path`` converted by ``converter_name``
+        :rtype: str
+        """
+        raw = '{}:{}:{}'.format(CACHE_VERSION, converter_name,
+                                self.content_hash(path))
+        return hashlib.sha1(raw).hexdigest()
+
+    def load(self, path, converter=etree_to_dict, name=None):
+        # type: (str, function, str) -> Any
+        """
+        Returns ``converter(path)``, from the cache if possible
+
+        :param str path: Source XML file
+        :param function converter: Called with ``path`` on a miss. Its result
+                                   must be picklable or an lxml element/tree.
+                                   (Default ``etree_to_dict``)
+        :param str name: Identifies ``converter`` in the cache key; defaults
+                         to its module & function name
+        :rtype: Any
+        """
+        if name is None:
+            name = '{}.{}'.format(getattr(converter, '__module__', ''),
+                                  getattr(converter, '__name__', converter))
+        entry = self._path('entries', self.key(path, name))
+        try:
+            with open(entry, 'rb') as fh:
+                kind, data = cPickle.load(fh)
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+            # missing, or evicted/replaced while we were opening it
+            pass
+        else:
+            self.hits += 1
+            try:
+                # bump the mtime so eviction is least recently *used*
+                os.utime(entry, None)
+            except OSError:
+                pass
+            if kind == 'tree':
+                return etree.fromstring(data).getroottree()
+            return etree.fromstring(data) if kind == 'xml' else data
+
+        self.misses += 1
+        result = converter(path)
+        if hasattr(result, 'getroot'):
+            # hand back the same type a miss does
+            packed = ('tree', etree.tostring(result))
+        elif etree.iselement(result):
+            packed = ('xml', etree.tostring(result))
+        else:
+            packed = ('pickle', result)
+        self._write(entry, cPickle.dumps(packed, cPickle.HIGHEST_PROTOCOL))
+        self.evict()
+        return result
+
+    def _write(self, path, data):
+        # type: (str, str) -> None
+        """
+        Atomically writes ``data`` to ``path`` via a temp file & rename
+
+        :param str path:
+        :param str data:
+        :rtype: None
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.rename(tmp, path)
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def size(self):
+        # type: () -> int
+        """
+        :returns: Total bytes used by cache entries & remembered file hashes
+        :rtype: int
+        """
+        return sum(st.st_size for _, st in self._entries())
+
+    def _entries(self):
+        # type: () -> list
+        """
+        :returns: (path, stat) for every entry & remembered file hash
+        :rtype: list
+        """
+        entries = []
+        for sub in ('entries', 'stats'):
+            base = os.path.join(self.directory, sub)
+            for name in os.listdir(base):
+                if name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(base, name)
+                try:
+                    entries.append((path, os.stat(path)))
+                except OSError:
+                    # removed by another process
+                    pass
+        return entries
+
+    def evict(self):
+        # type: () -> int
+        """
+        Removes least recently used entries & remembered file hashes until
+        the cache fits in ``max_bytes``
+
+        :returns: # of entries removed
+        :rtype: int
+        """
+        entries = self._entries()
+        total = sum(st.st_size for _, st in entries)
+        if total <= self.max_bytes:
+            return 0
+        removed = 0
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another process may have evicted while we waited
+                entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+                total = sum(st.st_size for _, st in entries)
+                for path, st in entries:
+                    if total <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+                    total -= st.st_size
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return removed
+
+    def clear(self):
+        # type: () -> None
+        """
+        Removes every entry & remembered file hash
+        """
+        for sub in ('entries', 'stats'):
+            base = os.path.join(self.directory, sub)
+            for name in os.listdir(base):
+                try:
+                    os.remove(os.path.join(base, name))
+                except OSError:
+                    pass
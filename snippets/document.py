@@ -0,0 +1,631 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight ``Document``/``Element`` builder
+
+The builder sketched in ``notes/outline.txt``: create a ``Document``, add
+``Element`` objects to it or to each other, give them attributes & typed
+values, then lower the whole thing to lxml or serialize it straight out::
+
+    >>> doc = Document('Deal', ns='urn:deal')
+    >>> customer = doc.root.add_child('Customer', attrib={'type': 'business'})
+    >>> customer.add_child('Name', 'ACME')
+    >>> customer.add_child('Since', date(2009, 4, 1), dtype='date')
+    >>> doc.root.add_child('Fees').add_children('Fee', fees, dtype='decimal')
+    >>> doc.serialize('/tmp/deal.xml')
+    >>> xml = doc.to_etree()
+
+Elements use ``__slots__`` and only allocate attribute/child containers once
+something is put in them, so big trees cost a fraction of the equivalent
+dicts or lxml nodes. Values are formatted for their data type when they're
+set, so bad values fail where they're assigned rather than at output time.
+
+An element's namespace is inherited from its parent unless it's given one
+(``ns=''`` means no namespace). Namespaces are resolved top-down as part of
+the single pass that builds the lxml tree or writes the output, so nodes
+never look up their ancestors.
+"""
+
+# Standard Library
+import re
+import base64
+import decimal
+import binascii
+import itertools
+from xml.sax.saxutils import escape
+
+# Third Party
+import six
+from lxml import etree
+
+# Local
+from stream import XML_NS, _text
+
+# what libxml2 escapes besides & < >
+_TEXT_ENTITIES = {'\r': '&#13;'}
+_ATTR_ENTITIES = {'"': '&quot;', '\n': '&#10;', '\r': '&#13;', '\t': '&#9;'}
+_NEEDS_ESCAPE = re.compile(u'[&<>\r]')
+# values used as-is when there's no data type
+_PLAIN = frozenset([str, unicode])
+
+
+def _boolean(value):
+    # type: (Any) -> str
+    if isinstance(value, six.string_types):
+        if value.strip().lower() in ('true', '1'):
+            return 'true'
+        if value.strip().lower() in ('false', '0'):
+            return 'false'
+        raise ValueError('Not a boolean: {!r}'.format(value))
+    return 'true' if value else 'false'
+
+
+def _integer(value):
+    # type: (Any) -> str
+    if isinstance(value, float) and not value.is_integer():
+        raise ValueError('Not an integer: {!r}'.format(value))
+    return str(int(value))
+
+
+def _decimal(value):
+    # type: (Any) -> str
+    if isinstance(value, float):
+        value = repr(value)
+    return str(decimal.Decimal(value))
+
+
+def _isoformat(value):
+    # type: (Any) -> str
+    if isinstance(value, six.string_types):
+        return value
+    return value.isoformat()
+
+
+def _normalized(value):
+    # type: (Any) -> unicode
+    text = _text(value)
+    for ch in '\t\r\n':
+        text = text.replace(ch, ' ')
+    return text
+
+
+# XML schema data type -> function formatting a value as that type's text
+DATA_TYPES = {
+    'string': _text,
+    'normalizedString': _normalized,
+    'token': lambda v: u' '.join(_text(v).split()),
+    'anyURI': _text,
+    'boolean': _boolean,
+    'integer': _integer,
+    'int': _integer,
+    'long': _integer,
+    'decimal': _decimal,
+    'float': lambda v: repr(float(v)),
+    'double': lambda v: repr(float(v)),
+    'date': _isoformat,
+    'dateTime': _isoformat,
+    'time': _isoformat,
+    'base64Binary': base64.b64encode,
+    'hexBinary': lambda v: binascii.hexlify(v).upper(),
+}
+
+
+def _format(value, dtype):
+    # type: (Any, str) -> Any
+    """
+    Formats ``value`` as text for ``dtype``
+
+    :param Any value:
+    :param str dtype: Key in ``DATA_TYPES``; ``None`` converts values the
+                      same way ``dict_to_etree()`` does
+    :rtype: Any
+    :raises: ValueError
+    """
+    if value is None:
+        return None
+    if dtype is None:
+        if value.__class__ in _PLAIN:
+            return value
+        fmt = _text
+    else:
+        try:
+            fmt = DATA_TYPES[dtype]
+        except KeyError:
+            raise ValueError('Unknown data type {!r}'.format(dtype))
+    try:
+        text = fmt(value)
+    except (TypeError, ValueError, AttributeError, decimal.InvalidOperation):
+        text = None
+    if text is None:
+        # _text() gives None for containers
+        raise ValueError('{!r} is not a valid {}'.format(value,
+                                                         dtype or 'value'))
+    return text
+
+
+def _attrib(attrib):
+    # type: (dict) -> dict
+    """
+    Formats every value in ``attrib`` the way ``Element.set_attr()`` does
+
+    :param dict attrib:
+    :rtype: dict
+    :raises: ValueError
+    """
+    return {k: _attr_value(v, None) for k, v in six.iteritems(attrib)}
+
+
+def _attr_value(value, dtype):
+    # type: (Any, str) -> Any
+    if value is None:
+        raise ValueError('Attribute values cannot be None; use del_attr()')
+    return _format(value, dtype)
+
+
+class Element(object):
+    """
+    A single node
+
+    :param str name: Tag name; Clark notation (``{uri}name``) sets ``ns``
+    :param Any value: Optional value, formatted for ``dtype``
+    :param dict attrib: Optional attributes
+    :param str ns: Namespace URI; ``None`` inherits the parent's, ``''`` is
+                   no namespace
+    :param dict nsmap: Optional ``{prefix: uri}`` declarations for this node
+    :param str dtype: Data type of the value; see ``DATA_TYPES``
+    """
+    __slots__ = ('name', 'ns', 'nsmap', 'attrib', 'text', 'dtype',
+                 'children')
+
+    def __init__(self, name, value=None, attrib=None, ns=None, nsmap=None,
+                 dtype=None):
+        if name[:1] == '{':
+            ns, name = name[1:].split('}', 1)
+        self.name = name
+        self.ns = ns
+        self.nsmap = nsmap or None
+        self.attrib = _attrib(attrib) if attrib else None
+        self.dtype = dtype
+        if value is None or (dtype is None and value.__class__ in _PLAIN):
+            self.text = value
+        else:
+            self.text = _format(value, dtype)
+        self.children = None
+
+    def __repr__(self):
+        return '<Element {}{} at 0x{:x}>'.format(
+            '{' + self.ns + '}' if self.ns else '', self.name, id(self))
+
+    def __len__(self):
+        return len(self.children) if self.children else 0
+
+    def __iter__(self):
+        return iter(self.children or ())
+
+    def __getitem__(self, index):
+        # type: (int) -> Element
+        if not self.children:
+            raise IndexError('Element has no children')
+        return self.children[index]
+
+    def find(self, name):
+        # type: (str) -> Element
+        """
+        :param str name: Local name of the child
+        :returns: The first child named ``name``, or ``None``
+        :rtype: Element
+        """
+        for child in self.children or ():
+            if child.name == name:
+                return child
+        return None
+
+    def add_child(self, child, value=None, attrib=None, ns=None, dtype=None):
+        # type: (Any, Any, dict, str, str) -> Element
+        """
+        Appends a child
+
+        :param str | Element child: An ``Element``, or the name of a new one
+                                    built from the other args
+        :param Any value: Value for a new child
+        :param dict attrib: Attributes for a new child
+        :param str ns: Namespace for a new child
+        :param str dtype: Data type for a new child's value
+        :returns: The child
+        :rtype: Element
+        """
+        if child.__class__ is not Element:
+            child = Element(child, value, attrib, ns, None, dtype)
+        if self.children is None:
+            self.children = [child]
+        else:
+            self.children.append(child)
+        return child
+
+    def extend(self, children):
+        # type: (Iterable) -> Element
+        """
+        Appends many ``Element`` objects at once
+
+        :param Iterable children:
+        :returns: This element
+        :rtype: Element
+        """
+        if self.children is None:
+            self.children = list(children)
+        else:
+            self.children.extend(children)
+        return self
+
+    def add_children(self, name, values, ns=None, dtype=None):
+        # type: (str, Iterable, str, str) -> Element
+        """
+        Appends a ``name`` child for every value in ``values``, e.g. thousands
+        of repeated line items
+
+        :param str name: Tag name of every child
+        :param Iterable values: One value per child
+        :param str ns: Namespace for the children
+        :param str dtype: Data type of the values
+        :returns: This element
+        :rtype: Element
+        """
+        if name[:1] == '{':
+            ns, name = name[1:].split('}', 1)
+        new = Element.__new__
+        children = []
+        append = children.append
+        for value in values:
+            # skip __init__; the name/namespace work is the same for every
+            # child
+            child = new(Element)
+            child.name = name
+            child.ns = ns
+            child.nsmap = child.attrib = child.children = None
+            child.dtype = dtype
+            child.text = _format(value, dtype)
+            append(child)
+        return self.extend(children)
+
+    def del_child(self, child):
+        # type: (Any) -> Element
+        """
+        Removes a child
+
+        :param int | Element child: The child or its index
+        :returns: The removed child
+        :rtype: Element
+        :raises: ValueError if ``child`` isn't a child of this element,
+                 IndexError for a bad index
+        """
+        if isinstance(child, six.integer_types):
+            if not self.children:
+                raise IndexError('Element has no children')
+            return self.children.pop(child)
+        for x, c in enumerate(self.children or ()):
+            if c is child:
+                return self.children.pop(x)
+        raise ValueError('{!r} is not a child of {!r}'.format(child, self))
+
+    def set_attr(self, name, value, dtype=None):
+        # type: (str, Any, str) -> Element
+        """
+        Sets an attribute; ``name`` may be in Clark notation
+
+        :param str name:
+        :param Any value:
+        :param str dtype: Optional data type to format ``value`` as
+        :returns: This element
+        :rtype: Element
+        :raises: ValueError if ``value`` is ``None`` or isn't valid for the
+                 data type
+        """
+        if self.attrib is None:
+            self.attrib = {}
+        self.attrib[name] = _attr_value(value, dtype)
+        return self
+
+    def del_attr(self, name):
+        # type: (str) -> Element
+        """
+        Removes an attribute
+
+        :param str name:
+        :returns: This element
+        :rtype: Element
+        :raises: KeyError if there's no such attribute
+        """
+        if not self.attrib:
+            raise KeyError(name)
+        del self.attrib[name]
+        return self
+
+    def set_value(self, value, dtype=None):
+        # type: (Any, str) -> Element
+        """
+        Sets the value
+
+        :param Any value: ``None`` clears it
+        :param str dtype: Data type; defaults to the element's current one
+        :returns: This element
+        :rtype: Element
+        :raises: ValueError if ``value`` isn't valid for the data type
+        """
+        if dtype is not None:
+            self.dtype = dtype
+        self.text = _format(value, self.dtype)
+        return self
+
+    def to_etree(self, parent_ns=''):
+        # type: (str) -> etree._Element
+        """
+        Builds the lxml equivalent of this element & its subtree in one pass
+
+        :param str parent_ns: Namespace to inherit if this element has none
+        :rtype: etree._Element
+        """
+        tags = {}
+
+        def tag_for(ns, name):
+            # type: (str, str) -> str
+            try:
+                return tags[ns, name]
+            except KeyError:
+                tag = tags[ns, name] = '{%s}%s' % (ns, name) if ns else name
+                return tag
+
+        ns = parent_ns if self.ns is None else self.ns
+        root = etree.Element(tag_for(ns, self.name), self.attrib,
+                             nsmap=self.nsmap)
+        root.text = self.text
+        sub = etree.SubElement
+        stack = [(self, root, ns)] if self.children else []
+        while stack:
+            node, el, ns = stack.pop()
+            for child in node.children:
+                cns = ns if child.ns is None else child.ns
+                try:
+                    tag = tags[cns, child.name]
+                except KeyError:
+                    tag = tag_for(cns, child.name)
+                new = sub(el, tag, child.attrib, nsmap=child.nsmap)
+                if child.text is not None:
+                    new.text = child.text
+                if child.children:
+                    stack.append((child, new, cns))
+        return root
+
+    def tostring(self, encoding='utf-8', parent_ns=''):
+        # type: (str, str) -> str
+        """
+        Serializes this element & its subtree in one pass, without building
+        any lxml nodes
+
+        :param str encoding: Output encoding (Default ``utf-8``)
+        :param str parent_ns: Namespace to inherit if this element has none
+        :rtype: str
+        """
+        return ''.join(_serialize(self, encoding, parent_ns))
+
+
+def _quote(value):
+    # type: (Any) -> Any
+    """
+    Escapes an attribute value the way libxml2 does, in double quotes
+    """
+    return u'"' + escape(value, _ATTR_ENTITIES) + u'"'
+
+
+def _serialize(root, encoding='utf-8', parent_ns='', chunk_size=65536):
+    # type: (Element, str, str, int) -> Iterator
+    """
+    Writes ``root``'s subtree out as encoded chunks, without recursion
+
+    Namespace scope (the default namespace & declared prefixes) is tracked
+    per open element, so a node only costs a dict lookup to get its prefix.
+    Namespaces nobody declared get an ``ns0``, ``ns1``, ... prefix declared
+    where they're first used, like lxml does.
+
+    :param Element root:
+    :param str encoding: Output encoding
+    :param str parent_ns: Namespace ``root`` inherits if it has none
+    :param int chunk_size: Approximate # of characters per chunk
+    :returns: Generator of ``encoding`` encoded byte strings
+    :rtype: Iterator
+    """
+    generated = [0]
+    out = []
+    size = 0
+
+    def prefix_for(uri, prefixes, decls):
+        # type: (str, dict, list) -> str
+        if uri == XML_NS:
+            return 'xml'
+        prefix = 'ns{}'.format(generated[0])
+        generated[0] += 1
+        prefixes[uri] = prefix
+        decls.append(u' xmlns:' + prefix + u'=' + _quote(uri))
+        return prefix
+
+    # (children left to write, end tag, default namespace, {uri: prefix},
+    #  namespace children inherit)
+    stack = [(iter((root,)), None, '', {}, parent_ns)]
+    while stack:
+        items, end, default, prefixes, ns = stack[-1]
+        node = next(items, None)
+        if node is None:
+            stack.pop()
+            if end is not None:
+                out.append(end)
+            continue
+        cns = ns if node.ns is None else node.ns
+        text = node.text
+        if text is not None and _NEEDS_ESCAPE.search(text):
+            text = escape(text, _TEXT_ENTITIES)
+        if cns == default and not (node.children or node.attrib or
+                                   node.nsmap):
+            # plain leaf, by far the most common node
+            name = node.name
+            if text is None:
+                part = u'<' + name + u'/>'
+            else:
+                part = u'<' + name + u'>' + text + u'</' + name + u'>'
+            out.append(part)
+            size += len(part)
+            if size >= chunk_size:
+                yield u''.join(out).encode(encoding, 'xmlcharrefreplace')
+                del out[:]
+                size = 0
+            continue
+        decls = []
+        if node.nsmap:
+            prefixes = dict(prefixes)
+            for prefix, uri in sorted(node.nsmap.items()):
+                if prefix:
+                    prefixes[uri] = prefix
+                    decls.append(u' xmlns:' + prefix + u'=' + _quote(uri))
+                else:
+                    default = uri
+                    decls.append(u' xmlns=' + _quote(uri))
+        if cns == default:
+            tag = node.name
+        elif not cns:
+            # un-declare the parent's default namespace
+            tag = node.name
+            default = ''
+            decls.append(u' xmlns=""')
+        else:
+            prefix = prefixes.get(cns)
+            if prefix is None:
+                if prefixes is stack[-1][3]:
+                    prefixes = dict(prefixes)
+                prefix = prefix_for(cns, prefixes, decls)
+            tag = prefix + ':' + node.name
+        if node.attrib:
+            attrs = []
+            for name, value in sorted(node.attrib.items()):
+                if name[:1] == '{':
+                    uri, name = name[1:].split('}', 1)
+                    prefix = prefixes.get(uri)
+                    if prefix is None:
+                        if prefixes is stack[-1][3]:
+                            prefixes = dict(prefixes)
+                        prefix = prefix_for(uri, prefixes, decls)
+                    name = prefix + ':' + name
+                attrs.append(u' ' + name + u'=' + _quote(value))
+            start = u'<' + tag + u''.join(decls) + u''.join(attrs)
+        elif decls:
+            start = u'<' + tag + u''.join(decls)
+        else:
+            start = u'<' + tag
+        if node.children:
+            part = start + u'>' + text if text else start + u'>'
+            stack.append((iter(node.children), u'</' + tag + u'>', default,
+                          prefixes, cns))
+        elif text is not None:
+            part = start + u'>' + text + u'</' + tag + u'>'
+        else:
+            part = start + u'/>'
+        out.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield u''.join(out).encode(encoding, 'xmlcharrefreplace')
+            del out[:]
+            size = 0
+    if out:
+        yield u''.join(out).encode(encoding, 'xmlcharrefreplace')
+
+
+class Document(object):
+    """
+    A document with a single root ``Element``
+
+    :param str | Element root: The root element, or its name
+    :param str ns: Namespace of a new root; declared as the default
+                   namespace unless ``nsmap`` says otherwise
+    :param dict nsmap: Optional ``{prefix: uri}`` declarations for a new root
+    :param dict attrib: Optional attributes for a new root
+    :param str encoding: Output encoding (Default ``utf-8``)
+    :param bool xml_dec: Write an XML declaration (Default ``True``)
+    """
+    __slots__ = ('root', 'encoding', 'xml_dec')
+
+    def __init__(self, root, ns=None, nsmap=None, attrib=None,
+                 encoding='utf-8', xml_dec=True):
+        if not isinstance(root, Element):
+            if ns and nsmap is None:
+                nsmap = {None: ns}
+            root = Element(root, attrib=attrib, ns=ns, nsmap=nsmap)
+        self.root = root
+        self.encoding = encoding
+        self.xml_dec = xml_dec
+
+    @classmethod
+    def from_dict(cls, data, root_name=None, **kwargs):
+        # type: (dict, str, **Any) -> Document
+        """
+        Builds a document from the same data ``dict_to_etree()`` takes, with
+        the same results
+
+        :param dict data:
+        :param str root_name: Optional name for the root; see
+                              ``dict_to_etree()``
+        :param dict kwargs: Passed on to ``Document``
+        :rtype: Document
+        """
+        if root_name is None:
+            if len(data.keys()) == 1:
+                root_name = data.keys()[0]
+                data = data.values()[0]
+            if not root_name:
+                root_name = 'root'
+        doc = cls(root_name, **kwargs)
+        stack = [(doc.root, data)]
+        while stack:
+            node, value = stack.pop()
+            if value is None:
+                continue
+            text = _text(value)
+            if text is not None:
+                node.text = text
+            elif isinstance(value, dict):
+                for k, v in six.iteritems(value):
+                    stack.append((node.add_child(k), v))
+            else:
+                # list items all go in ``node``, in order
+                stack.extend((node, v) for v in reversed(list(value)))
+        return doc
+
+    def to_etree(self):
+        # type: () -> etree._Element
+        """
+        :returns: The lxml equivalent of the document's root
+        :rtype: etree._Element
+        """
+        return self.root.to_etree()
+
+    def serialize(self, sink=None):
+        # type: (Any) -> Any
+        """
+        Writes the document out in a single pass, straight from the
+        ``Element`` tree
+
+        :param Any sink: File path or file-like object; ``None`` returns the
+                         output instead
+        :returns: The output bytes if ``sink`` is ``None``
+        :rtype: Any
+        """
+        chunks = _serialize(self.root, self.encoding)
+        if self.xml_dec:
+            head = "<?xml version='1.0' encoding='{}'?>\n".format(self.encoding)
+            chunks = itertools.chain([head], chunks)
+        if sink is None:
+            return ''.join(chunks)
+        close = isinstance(sink, six.string_types)
+        out = open(sink, 'wb') if close else sink
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if close:
+                out.close()
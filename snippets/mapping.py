@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+
+"""
+Declarative source -> target XML mappings
+
+A ``MappingSpec`` describes how values in a source document end up in a target
+document, e.g.::
+
+    >>> spec = MappingSpec('Contract', [
+    ...     Field('Customer/Name', 'Buyer/FullName', transform=str.upper),
+    ...     Field('Customer/@type', 'Buyer/@kind', default='individual'),
+    ...     Field('Vehicle/VIN', 'Asset/Id', min_occurs=1),
+    ...     Field('Fees/Fee', 'Charges/Charge', max_occurs=None),
+    ...     Field(None, 'Version', default='2'),
+    ... ], source_root='Deal')
+    >>> mapper = spec.compile()
+    >>> contract = mapper(deal_xml)
+
+Paths are ``/`` separated element names relative to the root node, the same
+way ``get_attr()`` looks up its ``target``. A trailing ``@name`` step refers
+to an attribute. Source paths ignore namespaces; target steps may use Clark
+notation (``{uri}Name``) if the output needs them.
+
+The compiled ``Mapper`` looks up each distinct source element path with a
+precompiled ``etree.XPath`` and builds the target directly with lxml; there
+is no stylesheet to load and the source is never copied. That is one query
+per distinct path rather than a single pass over the source: fields sharing a
+path share its query, and for the handful of paths a typical spec has this
+beats walking every node in Python. The gain over ``apply_xslt()`` is
+modest, though, about 1.1x - 1.6x (see ``bench_mapping()``), and specs with
+many distinct paths into a big document will narrow it further.
+
+``spec_from_xslt()`` can convert simple existing stylesheets (literal result
+elements with ``xsl:value-of``/``xsl:attribute``) into a ``MappingSpec``.
+"""
+
+# Standard Library
+import re
+from collections import OrderedDict
+
+# Third Party
+import six
+from lxml import etree
+
+# Local
+from utils import xml_as_etree, local_name
+
+XSL_NS = 'http://www.w3.org/1999/XSL/Transform'
+# a path step is an optional Clark namespace followed by anything but '/'
+PATH_STEP = re.compile(r'(?:\{[^}]*\})?[^/]+')
+# the only XPath the XSLT importer understands: name/name/@attr
+SIMPLE_SELECT = re.compile(r'^(?:[\w.-]+:)?[\w.-]+$')
+
+
+class MappingError(ValueError):
+    """
+    Raised for invalid mapping specs and for source documents that don't
+    satisfy a spec's cardinality rules
+    """
+
+
+def _as_text(value):
+    # type: (Any) -> Any
+    return value if isinstance(value, six.string_types) \
+        else six.text_type(value)
+
+
+def _literal(text):
+    # type: (str) -> str
+    """
+    Quotes ``text`` as an XPath 1.0 string literal; XPath has no escapes, so
+    text with both kinds of quote is built with ``concat()``
+
+    :param str text:
+    :rtype: str
+    """
+    if "'" not in text:
+        return "'{}'".format(text)
+    if '"' not in text:
+        return '"{}"'.format(text)
+    parts = ("'{}'".format(p) for p in text.split("'"))
+    return 'concat({})'.format(', "\'", '.join(parts))
+
+
+def _xpath(path):
+    # type: (tuple) -> etree.XPath
+    """
+    Compiles a source element path into a namespace agnostic ``etree.XPath``
+    relative to the source root, e.g. ``('Fees', 'Fee')`` ->
+    ``*[local-name()='Fees']/*[local-name()='Fee']``
+
+    :param tuple path: Element steps, no attribute; Clark namespaces are
+                       ignored
+    :rtype: etree.XPath
+    """
+    return etree.XPath('/'.join(
+        '*[local-name()={}]'.format(_literal(local_name(step)))
+        for step in path))
+
+
+def split_path(path):
+    # type: (Any) -> tuple
+    """
+    Splits a ``/`` separated path into a tuple of steps
+
+    Leading/trailing ``/`` and ``./`` steps are dropped. Tuples & lists are
+    returned as tuples so pre-split paths can be passed in as-is.
+
+    :param str | tuple path: Path to split
+    :rtype: tuple
+    """
+    if path is None:
+        return ()
+    if isinstance(path, (tuple, list)):
+        return tuple(path)
+    return tuple(s for s in PATH_STEP.findall(path) if s != '.')
+
+
+class Field(object):
+    """
+    A single source path -> target path mapping
+
+    :param str source: Source path, ``None`` for constant (``default``) values
+    :param str target: Target path
+    :param function transform: Optional callable applied to each source value;
+                               returning ``None`` drops the value
+    :param Any default: Value to use when the source has no match
+    :param int min_occurs: Minimum # of source matches (Default ``0``)
+    :param int max_occurs: Maximum # of source matches; ``None`` is unbounded.
+                           Anything other than ``1`` repeats the target's last
+                           step once per value. (Default ``1``)
+    """
+    def __init__(self, source, target, transform=None, default=None,
+                 min_occurs=0, max_occurs=1):
+        self.source = split_path(source)
+        self.target = split_path(target)
+        self.transform = transform
+        self.default = default
+        self.min_occurs = int(min_occurs)
+        self.max_occurs = max_occurs
+        if not self.target:
+            raise MappingError('Field target path cannot be empty')
+        if any(s.startswith('@') for s in self.source[:-1] + self.target[:-1]):
+            err = 'Attribute steps must be last: {!r} -> {!r}'
+            raise MappingError(err.format(source, target))
+        if self.repeats and self.target[-1].startswith('@'):
+            err = 'Attribute target {!r} cannot hold multiple values'
+            raise MappingError(err.format(target))
+
+    @property
+    def repeats(self):
+        # type: () -> bool
+        """``True`` if the field can produce more than one target node"""
+        return self.max_occurs != 1
+
+    def __repr__(self):
+        return 'Field({!r}, {!r})'.format('/'.join(self.source),
+                                          '/'.join(self.target))
+
+
+class MappingSpec(object):
+    """
+    An ordered set of ``Field`` mappings from one document type to another
+
+    :param str target_root: Tag name for the target document's root node
+    :param list fields: ``Field`` objects, in target document order
+    :param str source_root: Optional local name the source root must have
+    :param dict nsmap: Optional nsmap for the target root node
+    """
+    def __init__(self, target_root, fields=None, source_root=None, nsmap=None):
+        self.target_root = target_root
+        self.fields = list(fields or [])
+        self.source_root = source_root
+        self.nsmap = nsmap
+
+    def add(self, *args, **kwargs):
+        # type: (*Any, **Any) -> MappingSpec
+        """
+        Appends a ``Field`` built from ``args``/``kwargs``
+
+        :returns: self, so calls can be chained
+        :rtype: MappingSpec
+        """
+        self.fields.append(Field(*args, **kwargs))
+        return self
+
+    def compile(self):
+        # type: () -> Mapper
+        """
+        Compiles the spec into a reusable ``Mapper``
+
+        :rtype: Mapper
+        """
+        return Mapper(self)
+
+
+class Mapper(object):
+    """
+    Compiled form of a ``MappingSpec``; call it with a source document to get
+    the target document back as an ``etree._Element``.
+
+    Compiling builds a dispatch table of source element path ->
+    [(field index, attr)], and a compiled ``etree.XPath`` for each distinct
+    path, so every field sharing an element path is answered by one XPath
+    evaluation.
+    """
+    def __init__(self, spec):
+        # type: (MappingSpec) -> None
+        self.spec = spec
+        self.fields = tuple(spec.fields)
+        self.dispatch = OrderedDict()
+        for idx, field in enumerate(self.fields):
+            if not field.source:
+                continue
+            path, attr = field.source, None
+            if path[-1].startswith('@'):
+                path, attr = path[:-1], path[-1][1:]
+            self.dispatch.setdefault(path, []).append((idx, attr))
+        # (XPath, hits) per element path; ``None`` selects the root itself
+        self.paths = [(_xpath(path) if path else None, hits)
+                      for path, hits in six.iteritems(self.dispatch)]
+        self.plans = tuple(self._plan(f) for f in self.fields)
+
+    def __call__(self, xml):
+        # type: (Any) -> etree._Element
+        return self.map(xml)
+
+    def collect(self, xml):
+        # type: (Any) -> list
+        """
+        Gathers the raw source values for each field
+
+        :param Any xml: Source XML in any format ``xml_as_etree()`` accepts
+        :returns: A list of value lists, in field order
+        :rtype: list
+        """
+        root = xml_as_etree(xml)
+        if hasattr(root, 'getroot'):
+            root = root.getroot()
+        if not etree.iselement(root):
+            raise MappingError('Unable to parse source XML')
+        source_root = self.spec.source_root
+        if source_root is not None and local_name(root.tag) != source_root:
+            err = 'Expected source root {!r}, got {!r}'
+            raise MappingError(err.format(source_root, local_name(root.tag)))
+
+        values = [[] for _ in self.fields]
+        for xpath, hits in self.paths:
+            nodes = xpath(root) if xpath is not None else (root,)
+            for idx, attr in hits:
+                vals = values[idx]
+                if attr is None:
+                    vals.extend(node.text or '' for node in nodes)
+                    continue
+                for node in nodes:
+                    val = node.get(attr)
+                    if val is not None:
+                        vals.append(val)
+        return values
+
+    def map(self, xml):
+        # type: (Any) -> etree._Element
+        """
+        Maps ``xml`` into a new target document
+
+        :param Any xml: Source XML in any format ``xml_as_etree()`` accepts
+        :returns: The target document's root node
+        :rtype: etree._Element
+        :raises: MappingError if any cardinality rules are broken
+        """
+        values = self.collect(xml)
+        errors = []
+        target = etree.Element(self.spec.target_root, nsmap=self.spec.nsmap)
+        nodes = {(): target}
+        for field, plan, vals in six.moves.zip(self.fields, self.plans,
+                                               values):
+            found = len(vals)
+            if found < field.min_occurs or \
+                    (field.max_occurs is not None and found > field.max_occurs):
+                err = '{!r} matched {} time(s); expected {} to {}'
+                errors.append(err.format(field, found, field.min_occurs,
+                                         field.max_occurs or 'unbounded'))
+                continue
+            if field.transform is not None:
+                vals = [v for v in map(field.transform, vals) if v is not None]
+            if not vals and field.default is not None:
+                vals = [field.default]
+            if not vals:
+                continue
+            self._build(nodes, field, plan, vals)
+        if errors:
+            raise MappingError('\n'.join(errors))
+        return target
+
+    def map_many(self, docs):
+        # type: (Iterable) -> Iterator
+        """
+        Lazily maps a sequence of source documents
+
+        :param Iterable docs: Source documents
+        :rtype: Iterator
+        """
+        for doc in docs:
+            yield self.map(doc)
+
+    @staticmethod
+    def _plan(field):
+        # type: (Field) -> tuple
+        """
+        Works out once what ``_build()`` does for ``field``
+
+        :returns: (parent node keys, last step, attribute name or ``None``)
+        :rtype: tuple
+        """
+        steps = field.target
+        last = steps[-1]
+        attr = last[1:] if last[0] == '@' else None
+        parent_steps = steps[:-1] if (field.repeats or attr) else steps
+        keys = tuple(parent_steps[:x]
+                     for x in xrange(1, len(parent_steps) + 1))
+        return keys, last, attr
+
+    @staticmethod
+    def _build(nodes, field, plan, vals):
+        # type: (dict, Field, tuple, list) -> None
+        """
+        Creates the target node(s) for ``field``, re-using any nodes already
+        created for shared parent paths
+        """
+        keys, last, attr = plan
+        parent = nodes[()]
+        for key in keys:
+            node = nodes.get(key)
+            if node is None:
+                node = nodes[key] = etree.SubElement(parent, key[-1])
+            parent = node
+        if attr is not None:
+            parent.set(attr, _as_text(vals[-1]))
+        elif field.repeats:
+            sub = etree.SubElement
+            for val in vals:
+                sub(parent, last).text = _as_text(val)
+        else:
+            parent.text = _as_text(vals[-1])
+
+
+def spec_from_xslt(xslt):
+    # type: (Any) -> MappingSpec
+    """
+    Builds a ``MappingSpec`` from a simple XSLT stylesheet
+
+    Only "flat" stylesheets are supported: a single template whose body is
+    literal result elements, ``xsl:value-of`` with simple paths,
+    ``xsl:attribute``, ``xsl:text`` and ``{path}`` attribute value templates.
+    Anything involving ``for-each``, ``if``, ``choose``, ``apply-templates``
+    etc. raises a ``MappingError``.
+
+    :param str xslt: Either a path to a XSLT file or raw XSLT
+    :rtype: MappingSpec
+    :raises: MappingError
+    """
+    doc = xml_as_etree(xslt)
+    root = doc.getroot() if hasattr(doc, 'getroot') else doc
+    if not etree.iselement(root):
+        raise MappingError('Unable to parse XSLT')
+    templates = root.findall('{%s}template' % XSL_NS)
+    if len(templates) != 1:
+        err = 'Expected exactly 1 xsl:template, found {}'
+        raise MappingError(err.format(len(templates)))
+    template = templates[0]
+    match = split_path(template.get('match', ''))
+    if len(match) > 1:
+        err = 'Unsupported template match: {!r}'
+        raise MappingError(err.format(template.get('match')))
+
+    def unprefixed(step):
+        # type: (str) -> str
+        # source paths are namespace agnostic, so 'ns:Name' -> 'Name'
+        at = '@' if step.startswith('@') else ''
+        return at + step.lstrip('@').split(':')[-1]
+
+    source_root = unprefixed(local_name(match[0])) if match else None
+    results = [c for c in template if isinstance(c.tag, six.string_types)]
+    if len(results) != 1 or results[0].tag.startswith('{%s}' % XSL_NS):
+        raise MappingError('Template must have a single literal root element')
+
+    state = {'source_root': source_root}
+
+    def source(select):
+        # type: (str) -> tuple
+        select = (select or '').strip()
+        steps = tuple(unprefixed(s) for s in split_path(select))
+        if select.startswith('/') or not match:
+            # absolute paths, and anything relative to match="/", start with
+            # the source root
+            if not steps:
+                raise MappingError('Unsupported select: {!r}'.format(select))
+            head, steps = steps[0], steps[1:]
+            if state['source_root'] not in (None, head):
+                err = 'Mixed source roots: {!r} and {!r}'
+                raise MappingError(err.format(state['source_root'], head))
+            state['source_root'] = head
+        if not steps:
+            raise MappingError('Unsupported select: {!r}'.format(select))
+        for s in steps:
+            if not SIMPLE_SELECT.match(s.lstrip('@')):
+                raise MappingError('Unsupported select: {!r}'.format(select))
+        return steps
+
+    fields = []
+    # namespaces the result elements & attributes actually use
+    used = set()
+
+    def walk(node, path):
+        # type: (etree._Element, tuple) -> None
+        if node.tag[:1] == '{':
+            used.add(node.tag[1:].split('}', 1)[0])
+        for name, val in node.attrib.items():
+            if name[:1] == '{':
+                uri = name[1:].split('}', 1)[0]
+                if uri == XSL_NS:
+                    # e.g. xsl:exclude-result-prefixes on the result root
+                    continue
+                used.add(uri)
+            target = path + ('@' + name,)
+            if val.startswith('{') and val.endswith('}'):
+                fields.append(Field(source(val[1:-1]), target))
+            elif '{' in val:
+                raise MappingError('Unsupported attribute template: ' + val)
+            else:
+                fields.append(Field(None, target, default=val))
+        if node.text is not None and node.text.strip():
+            fields.append(Field(None, path, default=node.text.strip()))
+        for child in node:
+            if not isinstance(child.tag, six.string_types):
+                continue
+            if not child.tag.startswith('{%s}' % XSL_NS):
+                walk(child, path + (child.tag,))
+                continue
+            kind = local_name(child.tag)
+            if kind == 'value-of':
+                fields.append(Field(source(child.get('select')), path))
+            elif kind == 'text':
+                fields.append(Field(None, path, default=child.text or ''))
+            elif kind == 'attribute':
+                target = path + ('@' + child.get('name'),)
+                selects = child.findall('{%s}value-of' % XSL_NS)
+                if len(selects) == 1:
+                    field = Field(source(selects[0].get('select')), target)
+                elif not len(child) and child.text:
+                    field = Field(None, target, default=child.text)
+                else:
+                    raise MappingError('Unsupported xsl:attribute content')
+                fields.append(field)
+            else:
+                raise MappingError('Unsupported instruction: xsl:' + kind)
+
+    result_root = results[0]
+    walk(result_root, ())
+    # like XSLT, drop the XSL namespace & excluded prefixes unless a result
+    # node is in them
+    excluded = {XSL_NS}
+    for node, attr in ((root, 'exclude-result-prefixes'),
+                       (result_root, '{%s}exclude-result-prefixes' % XSL_NS)):
+        for prefix in (node.get(attr) or '').split():
+            if prefix == '#all':
+                excluded.update(node.nsmap.values())
+            else:
+                prefix = None if prefix == '#default' else prefix
+                excluded.add(node.nsmap.get(prefix))
+    nsmap = {k: v for k, v in six.iteritems(result_root.nsmap)
+             if v not in excluded or v in used} or None
+    return MappingSpec(result_root.tag, fields,
+                       source_root=state['source_root'], nsmap=nsmap)
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+
+"""
+Composable, lazily evaluated record pipelines
+
+Most services repeat the same chain: parse -> strip namespaces -> transform
+-> dict conversion/validation -> serialize. ``Pipeline`` chains those steps
+as generator stages over a stream of records::
+
+    >>> pipe = (Pipeline()
+    ...         .parse(tag='{urn:deal}Deal')
+    ...         .strip_namespaces()
+    ...         .transform('/path/to/deal.xsl')
+    ...         .validate(deal_rules, on_invalid=rejects.append)
+    ...         .to_dict(processes=4))
+    >>> for deal in pipe.run('/path/to/feed.xml'):
+    ...     save(deal)
+    >>> pipe.timings
+    {'parse': 1.92, 'strip_namespaces': 0.41, 'transform': 3.10, ...}
+
+Adjacent stages are fused into a single per-record function, so records are
+handed from one stage to the next as live ``etree._Element`` objects, never
+serialized in between. Stages given ``processes`` run in a ``multiprocessing``
+pool over batches of records; records only get serialized when they cross
+into/out of the pool.
+
+A stage that returns ``None`` drops the record.
+"""
+
+# Standard Library
+import multiprocessing
+from time import time
+from collections import OrderedDict
+
+# Third Party
+import six
+from lxml import etree
+
+# Local
+from utils import xml_as_etree, etree_to_dict, iter_subdivide, local_name
+from transform import compile_xslt
+
+# fused stages for the current pool worker, set by _init_worker()
+_WORKER_STAGES = None
+
+
+class _XmlBytes(bytes):
+    """
+    Marks a serialized ``etree._Element`` crossing a process boundary
+    """
+
+
+def _to_wire(record):
+    # type: (Any) -> Any
+    return _XmlBytes(etree.tostring(record)) if etree.iselement(record) \
+        else record
+
+
+def _from_wire(record):
+    # type: (Any) -> Any
+    return etree.fromstring(record) if isinstance(record, _XmlBytes) \
+        else record
+
+
+def strip_namespaces_inplace(xml):
+    # type: (etree._Element) -> etree._Element
+    """
+    Removes namespaces from ``xml`` in place
+
+    Cheaper than ``strip_namespaces()`` for records that are already parsed
+    since no XSLT or copy is involved.
+
+    :param etree._Element xml:
+    :returns: ``xml``
+    :rtype: etree._Element
+    """
+    for el in xml.iter():
+        tag = el.tag
+        if not isinstance(tag, six.string_types):
+            continue
+        if tag[:1] == '{':
+            el.tag = local_name(tag)
+        if any(k[:1] == '{' for k in el.attrib.keys()):
+            for k, v in el.attrib.items():
+                if k[:1] == '{':
+                    del el.attrib[k]
+                    el.set(local_name(k), v)
+    etree.cleanup_namespaces(xml)
+    return xml
+
+
+class Stage(object):
+    """
+    A named per-record function
+
+    :param str name: Stage name, used for timings
+    :param function fn: Called with each record; returning ``None`` drops it
+    :param int processes: Run in a pool of this many processes (Default
+                          ``None`` runs in-process)
+    :param int batch_size: Records per pool task (Default ``100``)
+    """
+    def __init__(self, name, fn, processes=None, batch_size=100):
+        self.name = name
+        self.fn = fn
+        self.processes = processes
+        self.batch_size = batch_size
+
+
+class FusedStages(object):
+    """
+    Several adjacent ``Stage`` functions applied to a record in one call
+
+    Picklable as long as the stage functions are, so it can be shipped to
+    pool workers once per worker.
+    """
+    def __init__(self, stages):
+        # type: (list) -> None
+        self.stages = [(s.name, s.fn) for s in stages]
+
+    def __call__(self, record, timings):
+        # type: (Any, dict) -> Any
+        for name, fn in self.stages:
+            s = time()
+            record = fn(record)
+            timings[name] = timings.get(name, 0.0) + (time() - s)
+            if record is None:
+                break
+        return record
+
+    def run_batch(self, batch):
+        # type: (list) -> tuple
+        """
+        Runs a batch of wire format records through the stages
+
+        :returns: (wire format results, timings)
+        :rtype: tuple
+        """
+        timings = {}
+        out = []
+        for record in batch:
+            record = self(_from_wire(record), timings)
+            if record is not None:
+                out.append(_to_wire(record))
+        return out, timings
+
+
+def _init_worker(fused):
+    # type: (FusedStages) -> None
+    global _WORKER_STAGES
+    _WORKER_STAGES = fused
+
+
+def _run_worker_batch(batch):
+    # type: (list) -> tuple
+    return _WORKER_STAGES.run_batch(batch)
+
+
+class Transform(object):
+    """
+    Picklable XSLT stage; the stylesheet is compiled once per process
+
+    :param str xslt: Either a path to a XSLT file or raw XSLT
+    :param dict params: Optional params, quoted the same way ``apply_xslt()``
+                        quotes them
+    """
+    def __init__(self, xslt, params=None):
+        self.xslt = xslt
+        self.params = {k: '"{}"'.format(v) for k, v in
+                       six.iteritems(params or {})}
+        self._transformer = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_transformer'] = None
+        return state
+
+    def __call__(self, record):
+        # type: (etree._Element) -> etree._Element
+        if self._transformer is None:
+            self._transformer = compile_xslt(self.xslt)
+        result = self._transformer(record, **self.params)
+        root = result.getroot()
+        return root if root is not None else result
+
+
+class Validate(object):
+    """
+    Picklable ``RuleSet`` stage; drops records with violations
+
+    Rules are checked relative to each record, so a ``RuleSet`` written for
+    whole documents with a ``scope`` works on the records it scopes to.
+
+    :param rules.RuleSet ruleset:
+    :param function on_invalid: Optional callable given ``(record,
+                                violations)`` for each dropped record. Only
+                                called in-process.
+    """
+    def __init__(self, ruleset, on_invalid=None):
+        self.ruleset = ruleset
+        self.on_invalid = on_invalid
+
+    def __call__(self, record):
+        # type: (etree._Element) -> etree._Element
+        violations = self.ruleset.validate_record(record)
+        if not violations:
+            return record
+        if self.on_invalid is not None:
+            self.on_invalid(record, violations)
+        return None
+
+
+class ToDict(object):
+    """
+    Picklable ``etree_to_dict()`` stage
+
+    :param bool stripped: Records have already had namespaces removed
+    :param Interner interner: Optional ``Interner`` shared by every record;
+                              each pool worker gets its own copy
+    """
+    def __init__(self, stripped=False, interner=None):
+        self.stripped = stripped
+        self.interner = interner
+
+    def __call__(self, record):
+        # type: (etree._Element) -> AttributeDict
+        return etree_to_dict(record, stripped=self.stripped,
+                             interner=self.interner)
+
+
+def _serialize(record):
+    # type: (etree._Element) -> str
+    return etree.tostring(record)
+
+
+def _pretty(record):
+    # type: (etree._Element) -> str
+    return etree.tostring(record, pretty_print=True)
+
+
+class Pipeline(object):
+    """
+    Builder for lazily evaluated record pipelines; see the module docs
+    """
+    def __init__(self):
+        self.source = None
+        self.stages = []  # type: list
+        # seconds spent in each stage, and # of records in/out, for the
+        # last run()
+        self.timings = OrderedDict()
+        self.counts = {'records': 0, 'output': 0}
+        self._stripped = False
+        # last record handed to the caller by run(); never cleared
+        self._output = None
+
+    def _name(self, name):
+        # type: (str) -> str
+        names = [s.name for s in self.stages]
+        x, unique = 1, name
+        while unique in names:
+            x += 1
+            unique = '{}#{}'.format(name, x)
+        return unique
+
+    def parse(self, tag=None, **kwargs):
+        # type: (str, **Any) -> Pipeline
+        """
+        Sets how ``run()`` input becomes records
+
+        With a ``tag`` the input is a single (huge) document, streamed with
+        ``iterparse`` and split into ``tag`` records that are cleared once the
+        pipeline is done with them. Records that come out of the pipeline
+        as-is (no serialize/to_dict stage) are detached from the document
+        instead, so they stay intact. Without one, the input is an iterable of
+        documents in any format ``xml_as_etree()`` accepts.
+
+        :param str tag: Record tag, in Clark notation if namespaced
+        :param dict kwargs: Passed on to ``etree.iterparse``
+        :rtype: Pipeline
+        """
+        self.source = (tag, kwargs)
+        return self
+
+    def map(self, fn, name=None, processes=None, batch_size=100):
+        # type: (function, str, int, int) -> Pipeline
+        """
+        Adds a custom stage
+
+        :param function fn: Called with each record; return ``None`` to drop
+                            it. Must be picklable if ``processes`` is set.
+        :param str name: Stage name for timings (Default ``fn.__name__``)
+        :param int processes: Run in a pool of this many processes
+        :param int batch_size: Records per pool task (Default ``100``)
+        :rtype: Pipeline
+        """
+        if name is None:
+            name = getattr(fn, '__name__', fn.__class__.__name__)
+        self.stages.append(Stage(self._name(name), fn, processes, batch_size))
+        return self
+
+    def strip_namespaces(self, **kwargs):
+        # type: (**Any) -> Pipeline
+        """Adds an in-place namespace stripping stage"""
+        self._stripped = True
+        return self.map(strip_namespaces_inplace, 'strip_namespaces', **kwargs)
+
+    def transform(self, xslt, params=None, **kwargs):
+        # type: (str, dict, **Any) -> Pipeline
+        """Adds a stage applying a compiled XSLT stylesheet"""
+        return self.map(Transform(xslt, params), 'transform', **kwargs)
+
+    def validate(self, ruleset, on_invalid=None, **kwargs):
+        # type: (Any, function, **Any) -> Pipeline
+        """Adds a stage dropping records that break ``ruleset``"""
+        return self.map(Validate(ruleset, on_invalid), 'validate', **kwargs)
+
+    def to_dict(self, interner=None, **kwargs):
+        # type: (Interner, **Any) -> Pipeline
+        """Adds an ``etree_to_dict()`` stage, optionally interning strings"""
+        fn = ToDict(stripped=self._stripped, interner=interner)
+        return self.map(fn, 'to_dict', **kwargs)
+
+    def serialize(self, pretty=False, **kwargs):
+        # type: (bool, **Any) -> Pipeline
+        """Adds a stage converting records to strings"""
+        fn = _pretty if pretty else _serialize
+        return self.map(fn, 'serialize', **kwargs)
+
+    def groups(self):
+        # type: () -> list
+        """
+        Fuses adjacent stages with the same ``processes`` setting
+
+        :returns: A list of ``(FusedStages, processes, batch_size)``
+        :rtype: list
+        """
+        groups = []
+        for stage in self.stages:
+            if groups and groups[-1][0][-1].processes == stage.processes:
+                groups[-1][0].append(stage)
+            else:
+                groups.append(([stage], stage.processes, stage.batch_size))
+        return [(FusedStages(g), p, b) for g, p, b in groups]
+
+    def _records(self, data):
+        # type: (Any) -> Iterator
+        """
+        Turns ``run()`` input into a stream of records
+
+        :rtype: Iterator
+        """
+        tag, kwargs = self.source or (None, {})
+        s = time()
+        if tag is None:
+            for doc in data:
+                tree = xml_as_etree(doc)
+                if hasattr(tree, 'getroot'):
+                    tree = tree.getroot()
+                self._tally('parse', time() - s)
+                self.counts['records'] += 1
+                yield tree
+                s = time()
+            return
+        kwargs.setdefault('huge_tree', True)
+        for event, el in etree.iterparse(data, tag=tag, **kwargs):
+            self._tally('parse', time() - s)
+            self.counts['records'] += 1
+            yield el
+            s = time()
+            if el is self._output:
+                # the record itself left the pipeline, so the caller owns it
+                # now; just detach it from the document, without the
+                # whitespace that followed it in the source
+                parent = el.getparent()
+                if parent is not None:
+                    parent.remove(el)
+                el.tail = None
+                continue
+            # downstream is done with el; let it go
+            el.clear()
+            parent = el.getparent()
+            if parent is not None:
+                while el.getprevious() is not None:
+                    del parent[0]
+
+    def _tally(self, name, seconds):
+        # type: (str, float) -> None
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def _in_process(self, records, fused):
+        # type: (Iterator, FusedStages) -> Iterator
+        # tallied per record, so timings are right even if the caller stops
+        # early
+        timings = self.timings
+        for record in records:
+            record = fused(record, timings)
+            if record is not None:
+                yield record
+
+    def _in_pool(self, records, fused, processes, batch_size):
+        # type: (Iterator, FusedStages, int, int) -> Iterator
+        # records have to be serialized before the batch is built, since
+        # streamed records are cleared as soon as the next one is parsed
+        batches = iter_subdivide((_to_wire(r) for r in records), batch_size)
+        pool = multiprocessing.Pool(processes, _init_worker, (fused,))
+        try:
+            for out, timings in pool.imap(_run_worker_batch, batches):
+                for name, seconds in six.iteritems(timings):
+                    self._tally(name, seconds)
+                for record in out:
+                    yield _from_wire(record)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def run(self, data):
+        # type: (Any) -> Iterator
+        """
+        Lazily runs ``data`` through the pipeline
+
+        :param Any data: A file path/file-like object when ``parse(tag)`` is
+                         used, otherwise an iterable of documents
+        :returns: A generator of processed records
+        :rtype: Iterator
+        """
+        self.timings.clear()
+        self.counts.update(records=0, output=0)
+        self.timings['parse'] = 0.0
+        records = self._records(data)
+        for stage in self.stages:
+            self.timings[stage.name] = 0.0
+        for fused, processes, batch_size in self.groups():
+            if processes:
+                records = self._in_pool(records, fused, processes, batch_size)
+            else:
+                records = self._in_process(records, fused)
+        try:
+            for record in records:
+                self.counts['output'] += 1
+                self._output = record
+                yield record
+        finally:
+            self._output = None
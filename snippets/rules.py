@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+
+"""
+User-configurable validation rules, checked in a single pass
+
+All of the rules for a document type go into one ``RuleSet``, e.g.::
+
+    >>> deal_rules = RuleSet([
+    ...     Required('Customer/@type'),
+    ...     Pattern('Vehicle/VIN', r'[A-HJ-NPR-Z0-9]{17}'),
+    ...     OneOf('Customer/@type', ['business', 'individual']),
+    ...     When('Customer/@type', equals='business',
+    ...          then=[Required('Customer/OrganizationData')]),
+    ...     When('IsLease', equals='true', then=[OneOf('DealType', ['L'])]),
+    ... ], scope='Deal')
+    >>> deal_rules.validate(feed_xml)
+    [Violation(path='/Feed/Deal[3]/Vehicle/VIN', ...)]
+
+Rule paths are relative to the ``scope`` node and ignore namespaces. The
+``scope`` is the path of the "record" node relative to the document root;
+``None`` makes the whole document a single record.
+
+Compiling the ``RuleSet`` turns the rules into a dispatch table keyed by
+element path, so every node is looked at once no matter how many rules there
+are. ``validate()`` walks an already parsed tree; ``filter()`` streams a file
+with ``iterparse`` and yields each record with its violations, discarding
+records as it goes so memory use stays flat on large feeds.
+"""
+
+# Standard Library
+import re
+from collections import namedtuple
+
+# Third Party
+import six
+from lxml import etree
+
+# Local
+from utils import xml_as_etree, local_name
+from mapping import split_path
+
+Violation = namedtuple('Violation', ['path', 'rule', 'message', 'value'])
+
+
+class RuleError(ValueError):
+    """
+    Raised for invalid rule definitions
+    """
+
+
+class Rule(object):
+    """
+    Base class for all rules
+
+    Value rules implement ``check()``, which is called with the text of every
+    matching node (or the attribute value, for ``@attr`` paths).
+
+    :param str path: Path to the node/attribute, relative to the scope node
+    :param str message: Optional message used for violations; ``{path}`` and
+                        ``{value}`` are filled in
+    """
+    message = '{path} is invalid: {value!r}'
+
+    def __init__(self, path, message=None):
+        self.path = split_path(path)
+        if not self.path:
+            err = '{} path cannot be empty'
+            raise RuleError(err.format(self.__class__.__name__))
+        if any(s.startswith('@') for s in self.path[:-1]):
+            raise RuleError('Attribute steps must be last: {!r}'.format(path))
+        if message is not None:
+            self.message = message
+
+    @property
+    def node_path(self):
+        # type: () -> tuple
+        """Path of the element the rule looks at"""
+        return self.path[:-1] if self.attr is not None else self.path
+
+    @property
+    def attr(self):
+        # type: () -> str
+        """Attribute name, or ``None`` if the rule applies to node text"""
+        last = self.path[-1]
+        return last[1:] if last.startswith('@') else None
+
+    def check(self, value):
+        # type: (str) -> bool
+        """
+        :param str value: Node text or attribute value
+        :returns: ``True`` if ``value`` passes the rule
+        :rtype: bool
+        """
+        return True
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, '/'.join(self.path))
+
+
+class Pattern(Rule):
+    """
+    Value must fully match the regex ``pattern``
+    """
+    message = '{path} does not match the expected format: {value!r}'
+
+    def __init__(self, path, pattern, message=None):
+        super(Pattern, self).__init__(path, message)
+        self.regex = re.compile(r'(?:{})\Z'.format(pattern))
+
+    def check(self, value):
+        return self.regex.match(value) is not None
+
+
+class OneOf(Rule):
+    """
+    Value must be one of ``values``
+    """
+    message = '{path} has an unexpected value: {value!r}'
+
+    def __init__(self, path, values, message=None):
+        super(OneOf, self).__init__(path, message)
+        self.values = frozenset(values)
+
+    def check(self, value):
+        return value in self.values
+
+
+class Check(Rule):
+    """
+    Value must pass the ``test`` callable
+    """
+    def __init__(self, path, test, message=None):
+        super(Check, self).__init__(path, message)
+        self.test = test
+
+    def check(self, value):
+        try:
+            return bool(self.test(value))
+        except Exception:
+            return False
+
+
+class Occurs(Rule):
+    """
+    Node/attribute must appear between ``min_occurs`` and ``max_occurs``
+    times per record; ``max_occurs=None`` is unbounded
+    """
+    message = '{path} found {value} time(s); expected {min} to {max}'
+
+    def __init__(self, path, min_occurs=1, max_occurs=None, message=None):
+        super(Occurs, self).__init__(path, message)
+        self.min_occurs = int(min_occurs)
+        self.max_occurs = max_occurs
+
+    def counts_ok(self, count):
+        # type: (int) -> bool
+        return self.min_occurs <= count and \
+            (self.max_occurs is None or count <= self.max_occurs)
+
+
+class Required(Occurs):
+    """
+    Node/attribute must appear at least once per record
+    """
+    message = '{path} is required'
+
+    def __init__(self, path, message=None):
+        super(Required, self).__init__(path, 1, None, message)
+
+
+class When(Rule):
+    """
+    The ``then`` rules only apply to records where the value at ``path``
+    equals ``equals`` (or passes the ``test`` callable)
+    """
+    def __init__(self, path, equals=None, test=None, then=()):
+        super(When, self).__init__(path)
+        self.equals = equals
+        self.test = test
+        self.then = list(then)
+        if any(isinstance(r, When) for r in self.then):
+            raise RuleError('Nested When() rules are not supported')
+
+    def applies(self, values):
+        # type: (list) -> bool
+        if self.test is None:
+            return self.equals in values
+        for value in values:
+            try:
+                if self.test(value):
+                    return True
+            except Exception:
+                pass
+        return False
+
+
+class RuleSet(object):
+    """
+    All of the rules for a document type, compiled into dispatch tables
+
+    :param list rules: ``Rule`` objects
+    :param str scope: Path of the record node relative to the document root,
+                      or ``None`` to treat the whole document as one record
+    """
+    def __init__(self, rules, scope=None):
+        self.rules = list(rules)
+        self.scope = split_path(scope)
+        # element path -> [(rule, attr, guard)] for value rules
+        self.values = {}  # type: dict
+        # element path -> [(attr, key)] for everything that is counted
+        self.counted = {}  # type: dict
+        # (rule, guard) pairs checked when a record ends
+        self.occurs = []  # type: list
+        # element path -> [(attr, When)] for conditions
+        self.conditions = {}  # type: dict
+        # guard=None means the rule always applies
+        for rule in self.rules:
+            self._add(rule, None)
+            if isinstance(rule, When):
+                for sub in rule.then:
+                    self._add(sub, rule)
+
+    def _add(self, rule, guard):
+        # type: (Rule, When) -> None
+        path, attr = rule.node_path, rule.attr
+        if isinstance(rule, When):
+            self.conditions.setdefault(path, []).append((attr, rule))
+        elif isinstance(rule, Occurs):
+            self.occurs.append((rule, guard))
+            counted = self.counted.setdefault(path, [])
+            if (attr, rule.path) not in counted:
+                counted.append((attr, rule.path))
+        elif isinstance(rule, Rule):
+            self.values.setdefault(path, []).append((rule, attr, guard))
+        else:
+            raise RuleError('Not a rule: {!r}'.format(rule))
+
+    def validate(self, xml):
+        # type: (Any) -> list
+        """
+        Checks every record in an in-memory document in a single traversal
+
+        :param Any xml: XML in any format ``xml_as_etree()`` accepts
+        :returns: Every ``Violation`` found, record by record
+        :rtype: list
+        """
+        tree = xml_as_etree(xml)
+        if not hasattr(tree, 'getroot') and not etree.iselement(tree):
+            raise RuleError('Unable to parse XML')
+        events = etree.iterwalk(tree, events=('start', 'end'))
+        violations = []
+        for record, found in self._run(events, clear=False):
+            violations.extend(found)
+        return violations
+
+    def validate_record(self, record):
+        # type: (Any) -> list
+        """
+        Checks a single record that has already been split out of its
+        document, e.g. by ``iterparse(tag=...)``
+
+        Rule paths are taken relative to ``record`` itself; ``scope`` is
+        ignored.
+
+        :param Any record: XML in any format ``xml_as_etree()`` accepts
+        :returns: Every ``Violation`` found
+        :rtype: list
+        """
+        tree = xml_as_etree(record)
+        if not hasattr(tree, 'getroot') and not etree.iselement(tree):
+            raise RuleError('Unable to parse XML')
+        events = etree.iterwalk(tree, events=('start', 'end'))
+        violations = []
+        for _, found in self._run(events, clear=False, scope=()):
+            violations.extend(found)
+        return violations
+
+    def filter(self, source, valid_only=False, **kwargs):
+        # type: (Any, bool, **Any) -> Iterator
+        """
+        Streams ``source`` and yields ``(record, violations)`` as each
+        record ends
+
+        Records are cleared once the consumer moves on to the next one, so
+        copy/serialize anything you need to keep.
+
+        :param Any source: File path or file-like object
+        :param bool valid_only: Only yield records without violations
+        :param dict kwargs: Passed on to ``etree.iterparse``
+        :rtype: Iterator
+        """
+        kwargs.setdefault('huge_tree', True)
+        events = etree.iterparse(source, events=('start', 'end'), **kwargs)
+        for record, found in self._run(events, clear=True):
+            if not (valid_only and found):
+                yield record, found
+
+    def _run(self, events, clear, scope=None):
+        # type: (Iterator, bool, tuple) -> Iterator
+        """
+        Drives the dispatch tables from a stream of start/end events
+
+        :param Iterator events: ``iterparse``/``iterwalk`` style events
+        :param bool clear: Discard each record after it's been yielded
+        :param tuple scope: Record path to use instead of ``self.scope``
+        :rtype: Iterator
+        """
+        scope = self.scope if scope is None else scope
+        depth = len(scope)
+        values, counted = self.values, self.counted
+        conditions = self.conditions
+        names = []  # local names from the document root down
+        rel = []    # paths relative to the scope node, once inside it
+        seen = [0]  # records seen, for the XPath style position
+        state = {}
+
+        def reset():
+            state['counts'] = {}
+            state['captured'] = {}
+            state['guarded'] = []
+            state['found'] = []
+
+        def where(path, attr):
+            # type: (tuple, str) -> str
+            prefix = '/' + '/'.join(names[:depth + 1])
+            out = '{}[{}]'.format(prefix, seen[0]) + ''.join(
+                '/' + s for s in path)
+            return out + ('/@' + attr if attr is not None else '')
+
+        def violation(rule, path, attr, value, **fmt):
+            # type: (Rule, tuple, str, Any, **Any) -> Violation
+            where_ = where(path, attr)
+            msg = rule.message.format(path=where_, value=value, **fmt)
+            return Violation(where_, rule, msg, value)
+
+        reset()
+        for event, el in events:
+            tag = el.tag
+            if not isinstance(tag, six.string_types):
+                continue
+            if event == 'start':
+                names.append(local_name(tag))
+                if len(names) == depth + 1 and tuple(names[1:]) == scope:
+                    seen[0] += 1
+                    rel.append(())
+                elif rel:
+                    rel.append(rel[-1] + (names[-1],))
+                continue
+
+            # 'end'
+            if rel:
+                path = rel.pop()
+                for attr, key in counted.get(path, ()):
+                    if attr is None or el.get(attr) is not None:
+                        counts = state['counts']
+                        counts[key] = counts.get(key, 0) + 1
+                for attr, cond in conditions.get(path, ()):
+                    val = (el.text or '').strip() if attr is None \
+                        else el.get(attr)
+                    if val is not None:
+                        state['captured'].setdefault(cond, []).append(val)
+                for rule, attr, guard in values.get(path, ()):
+                    val = (el.text or '').strip() if attr is None \
+                        else el.get(attr)
+                    if val is None or rule.check(val):
+                        continue
+                    v = violation(rule, path, attr, val)
+                    if guard is None:
+                        state['found'].append(v)
+                    else:
+                        state['guarded'].append((guard, v))
+                if not rel:
+                    yield el, self._finish(state, violation)
+                    reset()
+                    if clear:
+                        el.clear()
+                        # drop already processed siblings too; a root record
+                        # has no parent, only prolog comments/PIs
+                        parent = el.getparent()
+                        if parent is not None:
+                            while el.getprevious() is not None:
+                                del parent[0]
+            names.pop()
+
+    def _finish(self, state, violation):
+        # type: (dict, function) -> list
+        """
+        Runs the per-record checks once a record has ended
+
+        :returns: All violations for the record
+        :rtype: list
+        """
+        found = state['found']
+        captured = state['captured']
+        active = {}
+
+        def applies(guard):
+            # type: (When) -> bool
+            if guard is None:
+                return True
+            if guard not in active:
+                active[guard] = guard.applies(captured.get(guard, ()))
+            return active[guard]
+
+        for guard, v in state['guarded']:
+            if applies(guard):
+                found.append(v)
+        counts = state['counts']
+        for rule, guard in self.occurs:
+            count = counts.get(rule.path, 0)
+            if rule.counts_ok(count) or not applies(guard):
+                continue
+            found.append(violation(
+                rule, rule.node_path, rule.attr, count,
+                min=rule.min_occurs, max=rule.max_occurs or 'unbounded'))
+        return found
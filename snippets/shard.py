@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""
+Split huge feeds into well-formed shards at record boundaries, and merge
+processed shards back together
+
+Records are the root node's children. Every shard gets a copy of the root
+node (tag, attributes and namespace declarations) wrapped around its share of
+the records, so each one can be handled like a normal, smaller feed::
+
+    >>> index = split_feed('/data/feed.xml', '/data/shards', shards=8,
+    ...                    tag='{urn:deal}Deal')
+    >>> # ... workers process /data/shards/shard-0000.xml etc. in place ...
+    >>> merge_shards(index, '/data/feed.out.xml')
+
+Shards are balanced by the bytes written so far against the source size,
+so no counting pass over the source is needed. ``split_feed()`` also writes a
+JSON index with the byte range of the record block in each shard (and
+optionally of every record), so workers can seek straight to their records
+without parsing the wrapper.
+"""
+
+# Standard Library
+import os
+import json
+import uuid
+from xml.sax.saxutils import quoteattr
+
+# Third Party
+import six
+from lxml import etree
+
+# Local
+
+INDEX_NAME = '{}.index.json'
+
+
+def _wrapper(root):
+    # type: (etree._Element) -> tuple
+    """
+    Serializes ``root``'s start & end tags, with its attributes and namespace
+    declarations but none of its content
+
+    :param etree._Element root:
+    :returns: (start tag, end tag) as bytes
+    :rtype: tuple
+    """
+    shell = etree.Element(root.tag, dict(root.attrib), nsmap=root.nsmap)
+    marker = uuid.uuid4().hex
+    shell.text = marker
+    head, tail = _serialize(shell).split(marker, 1)
+    return head, tail
+
+
+def _serialize(el, declared=()):
+    # type: (etree._Element, tuple) -> str
+    """
+    Serializes ``el`` as utf-8 bytes, without a declaration or its tail
+
+    :param etree._Element el:
+    :param tuple declared: ``xmlns`` attributes, as serialized by lxml, that
+                           the wrapper already declares. lxml repeats them on
+                           every record serialized on its own, so they're
+                           removed from the start tag.
+    :rtype: str
+    """
+    data = etree.tostring(el, encoding='utf-8', xml_declaration=False,
+                          with_tail=False)
+    if declared:
+        end = data.index('>')
+        head = data[:end]
+        for decl in declared:
+            head = head.replace(decl, '', 1)
+        data = head + data[end:]
+    return data
+
+
+def _declared(root):
+    # type: (etree._Element) -> tuple
+    """
+    Returns ``root``'s namespace declarations the way lxml serializes them
+
+    :param etree._Element root:
+    :rtype: tuple
+    """
+    return tuple(' {}={}'.format('xmlns:' + p if p else 'xmlns',
+                                 quoteattr(uri).encode('utf-8'))
+                 for p, uri in six.iteritems(root.nsmap))
+
+
+def _records(source, tag=None, **kwargs):
+    # type: (Any, str, **Any) -> Iterator
+    """
+    Streams the root's children, clearing each one after it's been used
+
+    :param Any source: File path or file-like object
+    :param str tag: Record tag; other root children are yielded with
+                    ``is_record=False``
+    :returns: Generator of (root, child, is_record)
+    :rtype: Iterator
+    """
+    kwargs.setdefault('huge_tree', True)
+    depth = 0
+    root = None
+    for event, el in etree.iterparse(source, events=('start', 'end'),
+                                     **kwargs):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = el
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        yield root, el, tag is None or el.tag == tag
+        el.clear()
+        while el.getprevious() is not None:
+            del root[0]
+    if root is not None and not len(root):
+        # no children at all; still let the caller see the root
+        yield root, None, False
+
+
+class _ShardFile(object):
+    """
+    One output shard; tracks byte offsets as records are written
+    """
+    def __init__(self, path, head, tail):
+        self.path = path
+        self.tail = tail
+        self.fh = open(path, 'wb')
+        self.fh.write("<?xml version='1.0' encoding='utf-8'?>\n" + head + '\n')
+        self.pos = self.fh.tell()
+        self.start = None
+        self.end = None
+        self.records = 0
+        self.offsets = []
+
+    def write(self, data, is_record):
+        # type: (str, bool) -> None
+        if is_record:
+            if self.start is None:
+                self.start = self.pos
+            self.offsets.append(self.pos)
+            self.records += 1
+        self.fh.write(data)
+        self.pos += len(data)
+        if is_record:
+            self.end = self.pos
+
+    def close(self):
+        # type: () -> None
+        self.fh.write(self.tail + '\n')
+        self.fh.close()
+
+
+def split_feed(source, out_dir, shards=4, tag=None, prefix='shard',
+               record_offsets=False, **kwargs):
+    # type: (str, str, int, str, str, bool, **Any) -> str
+    """
+    Streams ``source`` into ``shards`` well-formed files of roughly equal size
+
+    Root children before the first ``tag`` record (headers etc.) are copied
+    into every shard; anything after the last record goes in the last shard.
+
+    :param str source: Path to the feed
+    :param str out_dir: Directory for the shards & index; created if needed
+    :param int shards: # of shards to write (Default ``4``)
+    :param str tag: Record tag, in Clark notation if namespaced. ``None``
+                    treats every root child as a record.
+    :param str prefix: Shard file name prefix (Default ``shard``)
+    :param bool record_offsets: Also index every record's offset in its shard
+    :param dict kwargs: Passed on to ``etree.iterparse``
+    :returns: Path to the JSON index
+    :rtype: str
+    """
+    shards = max(int(shards), 1)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    total = os.path.getsize(source)
+    index = {'source': os.path.abspath(source), 'tag': tag, 'shards': []}
+    preamble = []
+    current = None
+    seen = 0
+    # source bytes consumed so far, approximated by what's been serialized
+    # (plus the whitespace between nodes, which isn't)
+    consumed = 0
+    with open(source, 'rb') as fh:
+        for root, el, is_record in _records(fh, tag, **kwargs):
+            if current is None:
+                head, tail = _wrapper(root)
+                declared = _declared(root)
+                index['root'] = root.tag
+            if el is None:
+                break
+            data = _serialize(el, declared) + '\n'
+            consumed += len(data) + len(el.tail or '')
+            if not is_record:
+                if not seen:
+                    preamble.append(data)
+                else:
+                    current.write(data, False)
+                continue
+            due = len(index['shards']) < shards and (
+                current is None or
+                consumed - len(data) >= total * len(index['shards']) / shards)
+            if due:
+                if current is not None:
+                    current.close()
+                name = '{}-{:04d}.xml'.format(prefix, len(index['shards']))
+                current = _ShardFile(os.path.join(out_dir, name), head, tail)
+                for p in preamble:
+                    current.write(p, False)
+                index['shards'].append({'path': name, 'first_record': seen,
+                                        'shard': current})
+            current.write(data, True)
+            seen += 1
+    if current is None:
+        # no records at all; still write a single (empty) shard
+        name = '{}-0000.xml'.format(prefix)
+        current = _ShardFile(os.path.join(out_dir, name), head, tail)
+        for p in preamble:
+            current.write(p, False)
+        index['shards'].append({'path': name, 'first_record': 0,
+                                'shard': current})
+    current.close()
+
+    for entry in index['shards']:
+        shard = entry.pop('shard')
+        entry.update(records=shard.records, start=shard.start, end=shard.end,
+                     bytes=os.path.getsize(shard.path))
+        if record_offsets:
+            entry['offsets'] = shard.offsets
+    index['records'] = seen
+    index_path = os.path.join(out_dir, INDEX_NAME.format(prefix))
+    tmp = index_path + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(index, fh, indent=1)
+    os.rename(tmp, index_path)
+    return index_path
+
+
+def merge_shards(shards, dest, tag=None, **kwargs):
+    # type: (Any, Any, str, **Any) -> int
+    """
+    Streams ``shards`` back into a single document, in order
+
+    The root wrapper comes from the first shard. When the shards were split
+    with a ``tag``, root children before the first record in every shard
+    after the first are skipped, since they are copies of the preamble.
+
+    :param str | list shards: Path to a ``split_feed()`` index, or a list of
+                              shard paths in order
+    :param Any dest: File path or file-like object to write to
+    :param str tag: Record tag; read from the index if not given
+    :param dict kwargs: Passed on to ``etree.iterparse``
+    :returns: # of records written
+    :rtype: int
+    """
+    if isinstance(shards, six.string_types):
+        with open(shards) as fh:
+            index = json.load(fh)
+        base = os.path.dirname(shards)
+        shards = [os.path.join(base, s['path']) for s in index['shards']]
+        tag = tag if tag is not None else index.get('tag')
+    close = isinstance(dest, six.string_types)
+    out = open(dest, 'wb') if close else dest
+    tail = None
+    records = 0
+    try:
+        for x, path in enumerate(shards):
+            in_preamble = True
+            for root, el, is_record in _records(path, tag, **kwargs):
+                if tail is None:
+                    head, tail = _wrapper(root)
+                    declared = _declared(root)
+                    out.write("<?xml version='1.0' encoding='utf-8'?>\n" +
+                              head + '\n')
+                if el is None:
+                    break
+                in_preamble = in_preamble and not is_record
+                if x and tag is not None and in_preamble:
+                    continue
+                out.write(_serialize(el, declared) + '\n')
+                records += is_record
+        if tail is not None:
+            out.write(tail + '\n')
+    finally:
+        if close:
+            out.close()
+    return records
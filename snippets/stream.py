@@ -0,0 +1,654 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming XML helpers for documents too big to hold in memory
+
+``RecordWriter``/``write_records()``/``write_dict()`` are the streaming
+counterparts of ``dict_to_etree()`` + ``xml_as_str()``: values are written
+straight to a file or socket with ``etree.xmlfile`` as they are visited, so
+no tree or string is ever built. Nesting is handled with an explicit stack
+instead of recursion, so neither record counts nor depth are limited.
+
+``pretty_print()`` is the streaming counterpart of ``get_pretty_xml()``; it
+reads parse events incrementally and writes indented output to any file-like
+sink, discarding nodes as soon as they are written.
+
+``search()``/``find_first()`` are the streaming counterparts of
+``get_attr()``: they look up simple paths while parsing and stop reading as
+soon as every path has been found.
+"""
+
+# Standard Library
+import io
+import os
+import re
+import collections
+from xml.sax.saxutils import escape, quoteattr
+
+# Third Party
+import six
+from lxml import etree
+
+# Local
+
+XML_NS = 'http://www.w3.org/XML/1998/namespace'
+# either a run of '/' or a step: an optional Clark namespace followed by
+# anything but '/'
+_SEARCH_STEP = re.compile(r'(/+)|((?:\{[^}]*\})?[^/]+)')
+
+
+def _text(value):
+    # type: (Any) -> Any
+    """
+    Returns the text ``dict_to_etree()`` would use for a scalar ``value``, or
+    ``None`` if ``value`` is a container
+
+    :param Any value:
+    :rtype: Any
+    """
+    # this has to come first otherwise the int check catches it
+    if isinstance(value, bool):
+        return 'True' if value else 'False'
+    if isinstance(value, six.string_types):
+        return value
+    if isinstance(value, (int, float, long, complex)):
+        return six.text_type(value)
+    if isinstance(value, (dict, list, set, tuple, collections.Iterator)):
+        return None
+    return value.__class__.__name__
+
+
+def _children(value):
+    # type: (Any) -> Iterator
+    """
+    Returns an iterator of ``(tag, value)`` pairs for a container ``value``;
+    a ``tag`` of ``None`` means "write into the current element"
+
+    :param Any value: dict, list, set, tuple or any other iterator
+    :rtype: Iterator
+    """
+    if isinstance(value, dict):
+        return six.iteritems(value)
+    return ((None, v) for v in value)
+
+
+def write_value(xf, tag, value):
+    # type: (etree.xmlfile, str, Any) -> None
+    """
+    Writes ``value`` to an open ``etree.xmlfile`` the same way
+    ``dict_to_etree()`` would convert it, without recursion
+
+    :param etree.xmlfile xf: Open ``xmlfile`` context (the ``as`` target)
+    :param str tag: Tag for the element holding ``value``; ``None`` writes
+                    ``value`` into the currently open element
+    :param Any value: dict, list/set/tuple/generator, ``etree._Element`` or
+                      scalar value
+    :rtype: None
+    """
+    stack = [(iter([(tag, value)]), None)]
+    while stack:
+        items, ctx = stack[-1]
+        try:
+            tag, value = next(items)
+        except StopIteration:
+            stack.pop()
+            if ctx is not None:
+                ctx.__exit__(None, None, None)
+            continue
+        ctx = None
+        if tag is not None:
+            ctx = xf.element(tag)
+            ctx.__enter__()
+        if etree.iselement(value):
+            xf.write(value)
+        elif value is not None:
+            text = _text(value)
+            if text is None:
+                stack.append((_children(value), ctx))
+                continue
+            xf.write(text)
+        if ctx is not None:
+            ctx.__exit__(None, None, None)
+
+
+class RecordWriter(object):
+    """
+    Incrementally writes records inside a single root node
+
+    Usage::
+
+        >>> with RecordWriter('/tmp/out.xml', 'Deals', 'Deal') as writer:
+        ...     for deal in fetch_deals():
+        ...         writer.write(deal)
+
+    :param Any sink: File path or file-like object (e.g. ``socket.makefile()``)
+    :param str root_name: Tag for the root node
+    :param str record_name: Tag for each record. If ``None`` each record must
+                            be a ``{tag: value}`` dict, like the top level of
+                            ``dict_to_etree()`` data
+    :param dict nsmap: Optional nsmap for the root node
+    :param dict attrib: Optional attributes for the root node
+    :param str encoding: Output encoding (Default ``utf-8``)
+    :param bool xml_dec: Write an XML declaration (Default ``True``)
+    :param bool buffered: Let lxml buffer output (Default ``True``)
+    :param int flush_every: Flush after this many records; ``None`` leaves it
+                            up to lxml's buffering
+    :param int compression: gzip level for file output (Default ``0``)
+    """
+    def __init__(self, sink, root_name='root', record_name=None, nsmap=None,
+                 attrib=None, encoding='utf-8', xml_dec=True, buffered=True,
+                 flush_every=None, compression=0):
+        self.sink = sink
+        self.root_name = root_name
+        self.record_name = record_name
+        self.nsmap = nsmap
+        self.attrib = attrib or {}
+        self.encoding = encoding
+        self.xml_dec = xml_dec
+        self.buffered = buffered
+        self.flush_every = flush_every
+        self.compression = compression
+        self.count = 0
+        self._file = None
+        self._xf = None
+        self._root = None
+
+    def __enter__(self):
+        # type: () -> RecordWriter
+        self._file = etree.xmlfile(self.sink, encoding=self.encoding,
+                                   compression=self.compression,
+                                   buffered=self.buffered)
+        self._xf = self._file.__enter__()
+        if self.xml_dec:
+            self._xf.write_declaration()
+        self._root = self._xf.element(self.root_name, self.attrib,
+                                      nsmap=self.nsmap)
+        self._root.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self._root.__exit__(None, None, None)
+        self._file.__exit__(exc_type, exc_val, exc_tb)
+        self._xf = self._root = self._file = None
+
+    def write(self, record, tag=None):
+        # type: (Any, str) -> None
+        """
+        Writes a single record
+
+        :param Any record: Record data, see ``write_value()``
+        :param str tag: Optional tag to use instead of ``record_name``
+        :rtype: None
+        """
+        tag = tag or self.record_name
+        if tag is None and isinstance(record, dict):
+            for key, value in six.iteritems(record):
+                write_value(self._xf, key, value)
+        else:
+            write_value(self._xf, tag, record)
+        self.count += 1
+        if self.flush_every and not self.count % self.flush_every:
+            self._xf.flush()
+
+    def write_all(self, records):
+        # type: (Iterable) -> int
+        """
+        Writes every record in ``records``, which can be a generator
+
+        :param Iterable records:
+        :returns: Total # of records written so far
+        :rtype: int
+        """
+        for record in records:
+            self.write(record)
+        return self.count
+
+
+def write_records(records, sink, root_name='root', record_name=None,
+                  **kwargs):
+    # type: (Iterable, Any, str, str, **Any) -> int
+    """
+    Streams ``records`` into ``sink`` inside a ``root_name`` node
+
+    :param Iterable records: List or generator of records
+    :param Any sink: File path or file-like object
+    :param str root_name: Tag for the root node
+    :param str record_name: Tag for each record, see ``RecordWriter``
+    :param dict kwargs: Passed on to ``RecordWriter``
+    :returns: # of records written
+    :rtype: int
+    """
+    with RecordWriter(sink, root_name, record_name, **kwargs) as writer:
+        return writer.write_all(records)
+
+
+def write_dict(data, sink, root_name=None, **kwargs):
+    # type: (dict, Any, str, **Any) -> int
+    """
+    Streaming version of ``dict_to_etree()``; writes ``data`` to ``sink``
+    without building the tree
+
+    ``root_name`` follows the ``dict_to_etree()`` rules. Each top-level value
+    counts as a record for ``flush_every``, so generators at the top level
+    are streamed out as they are consumed.
+
+    :param dict data: Data to write
+    :param Any sink: File path or file-like object
+    :param str root_name: Optional name for the root node
+    :param dict kwargs: Passed on to ``RecordWriter``
+    :returns: # of top-level values written
+    :rtype: int
+    """
+    if root_name is None:
+        if len(data.keys()) == 1:
+            root_name = data.keys()[0]
+            data = data.values()[0]
+        if not root_name:
+            root_name = 'root'
+    with RecordWriter(sink, root_name, **kwargs) as writer:
+        if isinstance(data, dict):
+            records = six.iteritems(data)
+        elif _text(data) is None:
+            records = ((None, v) for v in data)
+        else:
+            records = [(None, data)]
+        for tag, value in records:
+            writer.write(value, tag)
+        return writer.count
+
+
+def _qname(name, nsmap):
+    # type: (str, dict) -> str
+    """
+    Converts a Clark notation name back into ``prefix:name`` using ``nsmap``
+
+    :param str name: Tag or attribute name
+    :param dict nsmap: ``{uri: prefix}`` lookup for the current element
+    :rtype: str
+    """
+    if name[:1] != '{':
+        return name
+    uri, local = name[1:].split('}', 1)
+    if uri == XML_NS:
+        return 'xml:' + local
+    prefix = nsmap.get(uri)
+    return (prefix + ':' + local) if prefix else local
+
+
+def _tag_name(el):
+    # type: (etree._Element) -> unicode
+    """
+    Returns ``el``'s tag as it appears in the source, i.e. ``prefix:name``
+
+    :param etree._Element el:
+    :rtype: unicode
+    """
+    tag = el.tag
+    if tag[:1] != '{':
+        return tag
+    local = tag.split('}', 1)[1]
+    return (el.prefix + ':' + local) if el.prefix else local
+
+
+def _start_tag(el, parent_nsmap):
+    # type: (etree._Element, dict) -> unicode
+    """
+    Builds ``el``'s start tag (without the closing ``>``), declaring only the
+    namespaces its parent hasn't already declared
+
+    :param etree._Element el:
+    :param dict parent_nsmap: The parent's ``nsmap``
+    :rtype: unicode
+    """
+    nsmap = el.nsmap
+    parts = [_tag_name(el)]
+    for prefix, uri in six.iteritems(nsmap):
+        if parent_nsmap.get(prefix) != uri:
+            name = ('xmlns:' + prefix) if prefix else 'xmlns'
+            parts.append(name + '=' + quoteattr(uri))
+    if len(el.attrib):
+        # attributes never use the default namespace
+        lookup = {uri: prefix for prefix, uri in six.iteritems(nsmap) if prefix}
+        for name, value in el.attrib.items():
+            parts.append(_qname(name, lookup) + '=' + quoteattr(value))
+    return u'<' + u' '.join(parts)
+
+
+def pretty_print(source, sink, indent='  ', max_records=None, max_depth=None,
+                 record_depth=1, encoding='utf-8', **kwargs):
+    # type: (Any, Any, str, int, int, int, str, **Any) -> int
+    """
+    Writes a pretty-printed copy of ``source`` to ``sink`` while parsing it
+
+    Unlike ``get_pretty_xml()`` the document is never held in memory, so this
+    is safe to use on multi-hundred-MB payloads. Output can be truncated to
+    the first ``max_records`` records and/or ``max_depth`` levels; anything
+    left out is marked with an XML comment.
+
+    :param Any source: File path or file-like object
+    :param Any sink: File-like object to write to, e.g. ``sys.stdout``
+    :param str indent: Indentation for each level (Default 2 spaces)
+    :param int max_records: Stop after this many records (Default ``None``)
+    :param int max_depth: Skip nodes deeper than this; the root is depth ``0``
+                          (Default ``None``)
+    :param int record_depth: Depth of the "record" nodes counted for
+                             ``max_records`` (Default ``1``, the root's
+                             children)
+    :param str encoding: Output encoding (Default ``utf-8``)
+    :param dict kwargs: Passed on to ``etree.iterparse``
+    :returns: # of records written
+    :rtype: int
+    """
+    kwargs.setdefault('remove_blank_text', True)
+    kwargs.setdefault('huge_tree', True)
+    events = etree.iterparse(source, events=('start', 'end', 'comment', 'pi'),
+                             **kwargs)
+
+    def out(text, depth):
+        # type: (unicode, int) -> None
+        sink.write((indent * depth + text + u'\n').encode(
+            encoding, 'xmlcharrefreplace'))
+
+    nsmaps = [{}]    # nsmap of every open element, for xmlns declarations
+    names = []       # tag names of the open, already written elements
+    pending = None   # element whose start tag waits to see if it has children
+    done = None      # last closed element, cleared once its tail is written
+    skipping = 0     # depth of the subtree being skipped for max_depth
+    skipped = False  # marker already written for the current run of skips
+    records = 0
+
+    def open_pending():
+        # type: () -> None
+        out(_start_tag(pending, nsmaps[-2]) + u'>', len(names))
+        names.append(_tag_name(pending))
+        text = (pending.text or '').strip()
+        if text:
+            out(escape(text), len(names))
+
+    def finish_done():
+        # type: () -> None
+        tail = (done.tail or '').strip()
+        if tail:
+            out(escape(tail), len(names))
+        done.clear()
+        # drop already written siblings so memory stays flat; the root has
+        # no parent, only prolog comments/PIs as siblings
+        parent = done.getparent()
+        if parent is not None:
+            while done.getprevious() is not None:
+                del parent[0]
+
+    for event, el in events:
+        if done is not None and done is not el:
+            finish_done()
+            done = None
+        if skipping:
+            if event == 'start':
+                skipping += 1
+            elif event == 'end':
+                skipping -= 1
+                if not skipping:
+                    done = el
+                else:
+                    # nothing below max_depth is written, so drop it as soon
+                    # as it's parsed instead of when the skipped subtree ends
+                    el.clear()
+                    parent = el.getparent()
+                    while el.getprevious() is not None:
+                        del parent[0]
+            continue
+        if pending is not None and event != 'end':
+            open_pending()
+            pending = None
+        depth = len(names)
+
+        if event in ('comment', 'pi'):
+            if max_depth is None or depth <= max_depth:
+                out(etree.tostring(el, encoding='unicode', with_tail=False),
+                    depth)
+            continue
+
+        if event == 'start':
+            if depth == record_depth and max_records is not None and \
+                    records >= max_records:
+                # checked before the record is opened, so max_records=0
+                # writes none
+                break
+            if max_depth is not None and depth > max_depth:
+                if not skipped:
+                    out(u'<!-- ... -->', depth)
+                    skipped = True
+                skipping = 1
+                continue
+            skipped = False
+            nsmaps.append(el.nsmap)
+            pending = el
+            continue
+
+        # 'end'
+        if pending is el:
+            text = (el.text or '').strip()
+            tag = _start_tag(el, nsmaps[-2])
+            if text:
+                end = u'</' + _tag_name(el) + u'>'
+                out(tag + u'>' + escape(text) + end, depth)
+            else:
+                out(tag + u'/>', depth)
+            pending = None
+        else:
+            out(u'</' + names.pop() + u'>', len(names))
+            depth = len(names)
+        nsmaps.pop()
+        skipped = False
+        done = el
+        if depth == record_depth:
+            records += 1
+    else:
+        return records
+
+    # truncated; close everything that is still open
+    out(u'<!-- truncated after {} records -->'.format(records), len(names))
+    while names:
+        out(u'</' + names.pop() + u'>', len(names))
+    return records
+
+
+def _compile_path(path):
+    # type: (str) -> tuple
+    """
+    Splits a search path into element steps & an optional attribute
+
+    :param str path: e.g. ``Header/Id``, ``//Deal/@id`` or ``*/Total``
+    :returns: (steps, attr) where steps is a tuple of ``(name, anywhere)``
+              and ``anywhere`` means the step may be any number of levels
+              below the previous one
+    :rtype: tuple
+    """
+    steps = []
+    attr = None
+    anywhere = False
+    for sep, step in _SEARCH_STEP.findall(path):
+        if sep:
+            anywhere = anywhere or len(sep) > 1
+            continue
+        if step == '.':
+            continue
+        if attr is not None:
+            raise ValueError('Attribute must be the last step in ' + path)
+        if step[:1] == '@':
+            attr = step[1:]
+            continue
+        steps.append((step, anywhere))
+        anywhere = False
+    if not steps and attr is None:
+        raise ValueError('Empty search path: {!r}'.format(path))
+    return tuple(steps), attr
+
+
+def search(source, paths, limit=1, **kwargs):
+    # type: (Any, Iterable, int, **Any) -> collections.OrderedDict
+    """
+    Finds the first ``limit`` matches of each path while parsing ``source``,
+    and stops parsing as soon as every path has them
+
+    Paths are ``/`` separated element names relative to the root node, the
+    same way ``get_attr()`` looks up its ``target``:
+
+    * ``Header/Id`` - the text of ``Id`` under the root's ``Header`` child
+    * ``Header/@id`` - an attribute value; ``Header/@*`` gives every
+      attribute as a dict
+    * ``//Id`` or ``Header//Id`` - ``Id`` at any depth below
+    * ``*`` - any element
+
+    Namespaces are ignored unless a step is in Clark notation
+    (``{uri}name``). A header field in the first few KB of a huge file only
+    costs parsing those KB.
+
+    :param Any source: File path, file-like object or XML string
+    :param Iterable paths: Paths to look for, all answered in the same pass
+    :param int limit: Max matches per path; ``None`` finds every match
+                      (Default ``1``)
+    :param dict kwargs: Passed on to ``etree.iterparse``
+    :returns: ``{path: [values in document order]}``, in ``paths`` order;
+              paths without a match get an empty list
+    :rtype: collections.OrderedDict
+    """
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+    results = collections.OrderedDict((p, []) for p in paths)
+    compiled = [_compile_path(p) for p in results]
+    values = list(results.values())
+    if limit is not None and limit < 1:
+        raise ValueError('limit must be at least 1')
+
+    close = False
+    if isinstance(source, six.string_types) and not os.path.isfile(source):
+        if source.lstrip()[:1] != '<':
+            raise IOError('No such file: {}'.format(source))
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        source = io.BytesIO(source)
+    elif isinstance(source, six.string_types):
+        # opened here so it's closed straight away when parsing stops early
+        source = open(source, 'rb')
+        close = True
+
+    kwargs.setdefault('huge_tree', True)
+    # paths still short of ``limit`` matches
+    open_paths = len(compiled)
+    # text matches waiting for their element's end event
+    waiting = 0
+    # per open element: (match states for every path, text slots to fill)
+    # where a state is the # of steps matched so far
+    stack = []
+    try:
+        for event, el in etree.iterparse(source, events=('start', 'end'),
+                                         **kwargs):
+            if event == 'end':
+                states, slots = stack.pop()
+                for values_, x in slots:
+                    values_[x] = el.text or ''
+                    waiting -= 1
+                if not open_paths and not waiting:
+                    break
+                el.clear()
+                parent = el.getparent()
+                if parent is not None:
+                    while el.getprevious() is not None:
+                        del parent[0]
+                continue
+
+            if not stack:
+                # paths are relative to the root, so it never matches itself
+                stack.append(([(0,) if s[0] else () for s in compiled], ()))
+                for x, (steps, attr) in enumerate(compiled):
+                    if not steps:
+                        # just '@attr', i.e. on the root
+                        _add_attr(el, attr, values[x], limit)
+                        open_paths -= 1
+                if not open_paths:
+                    break
+                continue
+            parent_states = stack[-1][0]
+            if not any(parent_states):
+                # nothing can match below here
+                stack.append((parent_states, ()))
+                continue
+            tag = el.tag
+            local = tag[tag.find('}') + 1:] if tag[:1] == '{' else tag
+            states = []
+            slots = []
+            completed = False
+            for x, current in enumerate(parent_states):
+                if not current:
+                    states.append(current)
+                    continue
+                steps, attr = compiled[x]
+                found = set()
+                matched = False
+                for s in current:
+                    name, anywhere = steps[s]
+                    if anywhere:
+                        found.add(s)
+                    if name == local or name == '*' or name == tag:
+                        if s + 1 == len(steps):
+                            matched = True
+                        else:
+                            found.add(s + 1)
+                if matched:
+                    if attr is not None:
+                        _add_attr(el, attr, values[x], limit)
+                    else:
+                        values[x].append(None)
+                        slots.append((values[x], len(values[x]) - 1))
+                        waiting += 1
+                    if limit is not None and len(values[x]) >= limit:
+                        open_paths -= 1
+                        completed = True
+                        found = ()
+                states.append(tuple(found))
+            if completed:
+                # paths that just got their last match stop matching anywhere
+                for x, v in enumerate(values):
+                    if len(v) >= limit:
+                        for frame in stack:
+                            frame[0][x] = ()
+            stack.append((states, slots))
+            if not open_paths and not waiting:
+                break
+    finally:
+        if close:
+            source.close()
+    return results
+
+
+def _add_attr(el, attr, values, limit):
+    # type: (etree._Element, str, list, int) -> None
+    if limit is not None and len(values) >= limit:
+        return
+    if attr == '*':
+        values.append(dict(el.attrib))
+    else:
+        value = el.get(attr)
+        if value is not None:
+            values.append(value)
+
+
+def find_first(source, path, default=None, **kwargs):
+    # type: (Any, str, Any, **Any) -> Any
+    """
+    Streaming counterpart of ``get_attr()``/``findtext()``; parsing stops at
+    the first match
+
+    E.g. ``find_first('/data/feed.xml', 'Header/@transactionId')``
+
+    :param Any source: File path, file-like object or XML string
+    :param str path: Path to look for; see ``search()``
+    :param Any default: Returned if nothing matches
+    :param dict kwargs: Passed on to ``etree.iterparse``
+    :returns: The text or attribute value(s) of the first match
+    :rtype: Any
+    """
+    found = search(source, [path], 1, **kwargs)[path]
+    return found[0] if found else default
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compiled chains of XSLT stylesheets
+
+Running several stylesheets in a row with ``strip_namespaces()`` and
+``apply_xslt()`` re-reads & compiles every stylesheet and serializes/parses
+the document again on every call. ``TransformChain`` compiles the whole chain
+once and hands each stage's result tree straight to the next stage::
+
+    >>> chain = TransformChain([
+    ...     '/path/to/normalize.xsl',
+    ...     ('/path/to/deal.xsl', {'dealer': 'D-100'}),
+    ...     '/path/to/export.xsl',
+    ... ], strip_namespaces=True)
+    >>> result = chain(xml)
+    >>> results = list(chain.transform_all(documents))
+    >>> chain.timings
+    OrderedDict([('strip_namespaces', 0.08), ('normalize', 0.21), ...])
+
+The chain is picklable (the compiled stylesheets are not pickled, they're
+compiled again on first use), so it can be used as a ``Pipeline`` stage that
+runs in a pool.
+"""
+
+# Standard Library
+import os
+from time import time
+from collections import OrderedDict
+
+# Third Party
+import six
+from lxml import etree
+
+# Local
+import vars
+from utils import xml_as_etree
+
+
+def compile_xslt(xslt):
+    # type: (Any) -> etree.XSLT
+    """
+    :param str | etree._Element | etree.XSLT xslt: Either a path to a XSLT
+                                                   file, raw XSLT or a parsed
+                                                   stylesheet
+    :returns: The compiled stylesheet
+    :rtype: etree.XSLT
+    """
+    if isinstance(xslt, etree.XSLT):
+        return xslt
+    xslt = xml_as_etree(xslt)
+    if hasattr(xslt, 'getroot'):
+        xslt = xslt.getroot()
+    return etree.XSLT(xslt)
+
+
+class TransformChain(object):
+    """
+    An ordered list of stylesheets applied as one transform
+
+    :param list stages: Stylesheets in the order to apply them. Each is either
+                        a path/raw XSLT, or a ``(xslt, params)`` tuple.
+                        ``params`` are quoted the same way ``apply_xslt()``
+                        quotes them.
+    :param bool strip_namespaces: Remove namespaces before the first stage,
+                                  the same way ``strip_namespaces()`` does
+    """
+    def __init__(self, stages, strip_namespaces=False):
+        self.stages = []
+        self.timings = OrderedDict()
+        self.documents = 0
+        if strip_namespaces:
+            xslt = os.path.join(vars.ETC_PATH, 'common',
+                                'RemoveNamespacesOnly.xsl')
+            self.add(xslt, name='strip_namespaces')
+        for stage in stages:
+            if isinstance(stage, tuple):
+                self.add(*stage)
+            else:
+                self.add(stage)
+        self._compiled = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_compiled'] = None
+        return state
+
+    def add(self, xslt, params=None, name=None):
+        # type: (Any, dict, str) -> TransformChain
+        """
+        Appends a stage
+
+        :param str xslt: Either a path to a XSLT file or raw XSLT
+        :param dict params: Optional params to pass on to the stylesheet
+        :param str name: Stage name for timings (Default the file name without
+                         its extension, or ``xslt`` for raw XSLT)
+        :rtype: TransformChain
+        """
+        if name is None:
+            name = 'xslt'
+            if isinstance(xslt, six.string_types) and '<' not in xslt:
+                name = os.path.splitext(os.path.basename(xslt))[0]
+        names = [s[0] for s in self.stages]
+        x, unique = 1, name
+        while unique in names:
+            x += 1
+            unique = '{}#{}'.format(name, x)
+        params = {k: '"{}"'.format(v) for k, v in six.iteritems(params or {})}
+        self.stages.append((unique, xslt, params))
+        self.timings[unique] = 0.0
+        self._compiled = None
+        return self
+
+    def compile(self):
+        # type: () -> list
+        """
+        Compiles every stage; called on first use if needed
+
+        :returns: (name, etree.XSLT, params) for each stage
+        :rtype: list
+        """
+        if self._compiled is None:
+            self._compiled = [(name, compile_xslt(xslt), params)
+                              for name, xslt, params in self.stages]
+        return self._compiled
+
+    def __call__(self, xml):
+        # type: (Any) -> etree._Element
+        """
+        Runs ``xml`` through every stage
+
+        :param str | etree._Element | etree._ElementTree xml: XML to transform
+        :returns: The last stage's result root, or the result tree itself for
+                  text output
+        :rtype: etree._Element
+        """
+        if not etree.iselement(xml) and not hasattr(xml, 'getroot'):
+            xml = xml_as_etree(xml)
+        timings = self.timings
+        result = xml
+        for name, transformer, params in self.compile():
+            s = time()
+            result = transformer(result, **params)
+            timings[name] += time() - s
+        self.documents += 1
+        root = result.getroot() if hasattr(result, 'getroot') else result
+        return root if root is not None else result
+
+    def transform_all(self, documents):
+        # type: (Iterable) -> Iterator
+        """
+        Lazily runs a batch of documents through the chain
+
+        :param Iterable documents: Anything ``__call__()`` accepts
+        :returns: Generator of results, in order
+        :rtype: Iterator
+        """
+        for xml in documents:
+            yield self(xml)
+
+    def reset(self):
+        # type: () -> None
+        """
+        Zeroes ``timings`` & ``documents``
+        """
+        for name in self.timings:
+            self.timings[name] = 0.0
+        self.documents = 0
@@ -6,6 +6,8 @@ Collection of commonly used/shared utilities
 
 # Standard Library
 import os
+import itertools
+import collections
 from lxml import etree
 import email.mime.text
 from pprint import PrettyPrinter
@@ -17,9 +19,13 @@ import six
 
 # Local
 import vars
-from extensions import AttributeDict, StrOrEtree
+from extensions import AttributeDict, Interner, ParseResult, StrOrEtree
 
 PP = PrettyPrinter()
+# how often each ParseResult outcome happened for documents parsed by
+# xml_as_result(), e.g. to report the error rate of partner feeds. Internal
+# parses (stylesheets, apply_xslt() round trips, ...) aren't counted.
+PARSE_STATS = collections.Counter()
 
 
 def create_file(path=None, mode=0777):
@@ -81,6 +87,48 @@ def subdivide_list(data, size=5):
     return [data[x:x + size] for x in xrange(0, len(data), size)]
 
 
+def iter_subdivide(data, size=5):
+    # type: (Iterable, int) -> Iterator
+    """
+    Generator version of ``subdivide_list()``; lazily yields lists with len
+    ``size`` from any iterable, including other generators
+
+    E.g.::
+
+        >>> data = (c for c in 'abcdefgh')
+        >>> list(iter_subdivide(data, 3))
+        [['a', 'b', 'c'], ['d', 'e', 'f'], ['g', 'h']]
+
+    :param Iterable data: The items to break into sub-lists
+    :param int size: Length of each sub-list
+    :return: A generator of lists with len ``size``
+    :rtype: Iterator
+    """
+    size = int(size)
+    data = iter(data)
+    while True:
+        chunk = list(itertools.islice(data, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def local_name(tag):
+    # type: (str) -> str
+    """
+    Returns the tag name without its namespace
+
+    E.g.::
+
+        >>> local_name('{http://www.example.com/ns}ResidenceAddress')
+        'ResidenceAddress'
+
+    :param str tag: Tag name, optionally in Clark ``{uri}name`` notation
+    :rtype: str
+    """
+    return tag.rsplit('}', 1)[-1] if tag[:1] == '{' else tag
+
+
 def strip_namespaces(xml_string=None):
     # type: (StrOrEtree) -> etree._Element
     """
@@ -193,33 +241,45 @@ def dict_to_etree(data={}, root_name=None):
     return xml
 
 
-def etree_to_dict(xml):
-    # type: (etree._ElementTree, bool) -> AttributeDict
+def etree_to_dict(xml, stripped=False, interner=None):
+    # type: (etree._ElementTree, bool, Interner) -> AttributeDict
     """
     Converts an etree object into an ``AttributeDict`` so it can be parsed
     similarly to soap responses where ``retxml=False``
 
     :param etree._ElementTree xml:
     :param bool stripped: Internal use flag indicating the xml has already
-                          had namespaces removed. Default is ``True`` so we
-                          don't have to muck around with partials
+                          had namespaces removed, e.g. by a pipeline stage.
+                          (Default ``False``)
+    :param Interner interner: Optional ``Interner`` to share tag, key and
+                              (optionally) value strings with other
+                              conversions
     :rtype: AttributeDict
     """
+    if interner is None:
+        name = value = lambda s: s
+        attr = lambda k: '@' + k
+    else:
+        name, attr, value = interner.name, interner.attr, interner.value
+
     def convert(_xml):
-        tag = _xml.tag
+        tag = name(_xml.tag)
         txt = _xml.text if _xml.text is not None and len(_xml.text) else ''
         d = AttributeDict({tag: map(convert, _xml.iterchildren())})
-        d.update(('@' + k, v) for k, v in _xml.attrib.iteritems())
+        d.update((attr(k), value(v)) for k, v in _xml.attrib.iteritems())
         # set text as value for tag so . notation works
         if not len(d[tag]) and len(txt):
-            d[tag] = txt
+            d[tag] = value(txt)
         # don't make the xml children be in a list, again so . notation works
         elif isinstance(d[tag], list):
             d[tag] = {k: v for child in d[tag] for k, v in six.iteritems(child)}
         return d
 
     # sanitize for safety
-    xml = strip_namespaces(xml)  # type: etree._Element
+    if not stripped:
+        xml = strip_namespaces(xml)  # type: etree._Element
+    elif hasattr(xml, 'getroot'):
+        xml = xml.getroot()
     xml_dict = convert(xml)
     # top level node is the first dict entry, which needs to bump up a level
     keys = xml_dict.keys()
@@ -252,6 +312,23 @@ def xml_as_etree(xml):
     return get_xml_as(xml, fmt='etree')
 
 
+def xml_as_result(xml):
+    # type: (Any) -> ParseResult
+    """
+    Parses ``xml`` once, recovering from malformed input where possible
+
+    Use this instead of ``xml_as_etree()`` on dirty partner feeds, so bad
+    input is parsed once and its errors are reported instead of the raw input
+    being handed back to be parsed (and fail) again downstream.
+
+    :param Any xml: (:py:class:`str` | :py:class:`etree._ElementTree`) XML to
+                    parse
+    :returns: The tree, outcome & any recovered errors
+    :rtype: ParseResult
+    """
+    return get_xml_as(xml, fmt='result')
+
+
 def xml_as_stringio(xml, pretty=False):
     # type: (Any, bool) -> StringIO
     """
@@ -297,41 +374,61 @@ def get_xml_as(xml, fmt='', pretty=False):
     """
     Makes sure ``xml`` is in ``fmt``, with the option to be pretty
 
+    With ``fmt='result'`` the document is parsed exactly once with a
+    recover-mode parser and a ``ParseResult`` is returned instead of silently
+    handing back the raw input on syntax errors. A recover-mode parse that
+    logs no errors is identical to a strict parse, so there's no need to try
+    both.
+
+    Parses with ``fmt='result'`` are counted in ``PARSE_STATS`` by outcome;
+    the other formats are used for stylesheets & internal round trips, so
+    counting them would dilute the error rate.
+
     :param Any xml: (:py:class:`str` | :py:class:`etree._ElementTree`) XML to
                     convert
-    :param str fmt: Format to return ``xml`` in ('string', 'etree')
+    :param str fmt: Format to return ``xml`` in ('string', 'etree', 'result')
     :param bool pretty: Flag to pretty format ``xml`` if ``fmt`` is ``string``
     :returns: ``xml`` in format ``fmt``
     :rtype: Any
     """
+    asresult = True if fmt == 'result' else False
     if xml is None or not len(str(xml)):
-        return xml
+        return ParseResult() if asresult else xml
     astree = True if fmt == 'etree' else False
     klass = '' if not hasattr(xml, '__class__') else str(xml.__class__)
     # This is VERY important; we sometimes get XML back with random new line
     # characters that prevent etree from pretty printing and this is the ONLY
     # reliable way to fix it.
-    parser = etree.XMLParser(remove_blank_text=True)
+    parser = etree.XMLParser(remove_blank_text=True, recover=asresult)
+    # the recover parser has to see every parse so its errors can be reported
+    kw = {'parser': parser} if asresult else {}
+    parsed = True
     try:
         if isinstance(xml, six.string_types):
             xml = xml.strip()
             if os.path.isfile(xml):
-                mxml = etree.parse(xml)
+                mxml = etree.parse(xml, **kw)
             else:
                 if isinstance(xml, unicode):
                     xml = xml.encode('utf8')
                 mxml = etree.XML(xml, parser=parser)
         elif 'etree' in klass or 'lxml' in klass:
             mxml = xml
+            parsed = False
         elif 'StringIO' in klass:
-            mxml = etree.parse(xml)
+            mxml = etree.parse(xml, **kw)
         elif isinstance(xml, file):
             mxml = etree.parse(xml, parser=parser)
         else:
             err = 'unhandled type in _get_xml_as(): {}'.format(type(xml))
             raise ValueError(err)
+        if asresult:
+            return _parse_result(mxml, parser, parsed)
         return mxml if astree else etree.tostring(mxml, pretty_print=pretty)
     except etree.XMLSyntaxError as ex:
+        if asresult:
+            PARSE_STATS[ParseResult.FAILED] += 1
+            return ParseResult(None, ParseResult.FAILED, [str(ex)])
         # the WeOwe.read deal request sometimes returns XML with undefined
         # namespaces; all we can do is return whatever we were given
         return xml
@@ -342,6 +439,33 @@ def get_xml_as(xml, fmt='', pretty=False):
         raise
 
 
+def _parse_result(mxml, parser, parsed):
+    # type: (Any, etree.XMLParser, bool) -> ParseResult
+    """
+    Builds the ``ParseResult`` for a recover-mode parse & counts its outcome
+
+    :param Any mxml: Whatever the parser returned
+    :param etree.XMLParser parser: The recover-mode parser that was used
+    :param bool parsed: ``False`` if ``mxml`` was already an etree object
+    :rtype: ParseResult
+    """
+    errors = []
+    if parsed:
+        errors = ['{}:{}: {}'.format(e.line, e.column, e.message)
+                  for e in parser.error_log
+                  if e.level >= etree.ErrorLevels.ERROR]
+    root = mxml.getroot() if hasattr(mxml, 'getroot') else mxml
+    if root is None:
+        outcome, mxml = ParseResult.FAILED, None
+    elif errors:
+        outcome = ParseResult.RECOVERED
+    else:
+        outcome = ParseResult.STRICT
+    if parsed:
+        PARSE_STATS[outcome] += 1
+    return ParseResult(mxml, outcome, errors)
+
+
 def prettify(data):
     # type: (Any) -> str
     """